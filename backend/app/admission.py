@@ -0,0 +1,184 @@
+import argparse
+import contextvars
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+
+import metrics
+from cache import LRUCache
+
+# Admission control for LLM calls. Each user has two token buckets, one for
+# requests and one for LLM tokens, sized by their tier; a request that would
+# overdraw either is rejected with 429 and a Retry-After. Admitted requests
+# carry the caller in a context variable so llm.limiter can queue them fairly
+# by tier weight. Buckets live in process memory, so with several server
+# processes each enforces its own share.
+DEFAULT_TIERS = {
+    "free": {"requests_per_minute": 20, "tokens_per_minute": 60000, "weight": 1},
+    "pro": {"requests_per_minute": 120, "tokens_per_minute": 400000, "weight": 4},
+    # None means unlimited.
+    "admin": {"requests_per_minute": None, "tokens_per_minute": None, "weight": 8},
+}
+# e.g. LLM_TIERS='{"pro": {"requests_per_minute": 300}, "team": {"requests_per_minute": 60, "tokens_per_minute": 200000, "weight": 2}}'
+TIERS = {
+    name: {**DEFAULT_TIERS.get(name, DEFAULT_TIERS["free"]), **overrides}
+    for name, overrides in {**{name: {} for name in DEFAULT_TIERS}, **json.loads(os.getenv("LLM_TIERS", "{}"))}.items()
+}
+LLM_DEFAULT_TIER = os.getenv("LLM_DEFAULT_TIER", "free")
+# Usernames treated as admins whatever their stored tier.
+LLM_ADMIN_USERS = {name.strip() for name in os.getenv("LLM_ADMIN_USERS", "").split(",") if name.strip()}
+BUCKET_CACHE_SIZE = int(os.getenv("LLM_BUCKET_CACHE_SIZE", "100000"))
+
+RATE_LIMITED = metrics.Counter("llm_rate_limited_total", "LLM requests rejected by a user's token bucket.", ["tier", "bucket"])
+
+
+class TokenBucket:
+    """Holds up to a minute's allowance and refills continuously. The balance may
+    go negative when actual usage exceeds what was charged up front; the debt is
+    paid off before the next request is admitted."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken; 0 if it can be taken now."""
+        self._refill()
+        # A request bigger than the whole bucket only needs it full, not overfull.
+        needed = min(amount, self.capacity) - self.tokens
+        return max(needed, 0) / self.rate if self.rate else float("inf")
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+
+@dataclass
+class Caller:
+    userId: str
+    tier: str
+    weight: float
+    # Tokens charged up front for the current request, refunded once real usage is known.
+    estimate: int = 0
+
+
+_current = contextvars.ContextVar("llm_caller", default=None)
+_buckets = LRUCache(BUCKET_CACHE_SIZE)
+_lock = threading.Lock()
+
+
+def tier_of(user: dict) -> str:
+    if user["username"] in LLM_ADMIN_USERS:
+        return "admin"
+    tier = user.get("tier") or LLM_DEFAULT_TIER
+    return tier if tier in TIERS else LLM_DEFAULT_TIER
+
+
+def _user_buckets(userId: str, tier: str):
+    limits = TIERS[tier]
+    entry = _buckets.get(userId)
+    if entry is None or entry[0] != tier:
+        entry = (
+            tier,
+            TokenBucket(limits["requests_per_minute"]) if limits["requests_per_minute"] else None,
+            TokenBucket(limits["tokens_per_minute"]) if limits["tokens_per_minute"] else None,
+        )
+        _buckets.set(userId, entry)
+    return entry[1], entry[2]
+
+
+def admit(user: dict, tokens: int, requests: int = 1) -> Caller:
+    """Charge a request (or `requests` of them) and its estimated tokens to the
+    user's buckets, or raise 429. Binds the caller to the current context."""
+    tier = tier_of(user)
+    requests_bucket, tokens_bucket = _user_buckets(user["username"], tier)
+    with _lock:
+        for name, bucket, amount in (("requests", requests_bucket, requests), ("tokens", tokens_bucket, tokens)):
+            if bucket is None:
+                continue
+            wait = bucket.wait_time(amount)
+            if wait > 0:
+                RATE_LIMITED.inc(tier=tier, bucket=name)
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Rate limit exceeded for your {tier} plan ({name} per minute). Please retry later.",
+                    headers={"Retry-After": str(max(int(wait + 0.999), 1))}
+                )
+        if requests_bucket is not None:
+            requests_bucket.take(requests)
+        if tokens_bucket is not None:
+            tokens_bucket.take(tokens)
+    return bind(user["username"], tier, estimate=tokens)
+
+
+def bind(userId: str, tier: str, estimate: int = 0) -> Caller:
+    """Attribute LLM calls in the current context to a user without charging them,
+    e.g. for a queued job that was admitted when it was submitted."""
+    caller = Caller(userId, tier, TIERS[tier]["weight"], estimate)
+    _current.set(caller)
+    return caller
+
+
+def current():
+    return _current.get()
+
+
+def settle(response):
+    """Charge the real token usage reported on an LLM response in place of the estimate."""
+    caller = _current.get()
+    if caller is None:
+        return
+    usage = getattr(response, "usage_metadata", None)
+    # Without reported usage the estimate stands as the charge.
+    if usage is not None:
+        used = (getattr(usage, "prompt_token_count", 0) or 0) + (getattr(usage, "candidates_token_count", 0) or 0)
+        _, tokens_bucket = _user_buckets(caller.userId, caller.tier)
+        if tokens_bucket is not None:
+            with _lock:
+                tokens_bucket.take(used - caller.estimate)
+    caller.estimate = 0
+
+
+def refund(caller: Caller):
+    """Give back the tokens charged up front that no LLM response has settled,
+    e.g. for a request answered from the cache or one that failed."""
+    if caller is None or not caller.estimate:
+        return
+    _, tokens_bucket = _user_buckets(caller.userId, caller.tier)
+    if tokens_bucket is not None:
+        with _lock:
+            tokens_bucket.take(-caller.estimate)
+    caller.estimate = 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage users' LLM rate-limit tiers.")
+    parser.add_argument("--set-tier", nargs=2, metavar=("USERNAME", "TIER"))
+    args = parser.parse_args()
+    if not args.set_tier:
+        parser.error("nothing to do; pass --set-tier USERNAME TIER")
+    username, tier = args.set_tier
+    if tier not in TIERS:
+        parser.error(f"unknown tier {tier!r}; expected one of {', '.join(TIERS)}")
+
+    import db
+    import migrations
+
+    migrations.migrate()
+    with db.connection() as conn:
+        updated = conn.execute("UPDATE users SET tier = ? WHERE username = ?", (tier, username)).rowcount
+        conn.commit()
+    if not updated:
+        raise SystemExit(f"No user named {username!r}")
+    print(f"{username} is now on the {tier} tier (signed-in sessions pick it up within AUTH_CACHE_TTL_SECONDS).")
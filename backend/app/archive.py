@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import time
+import zlib
+
+import db
+import metrics
+from cache import LRUCache
+
+# Chats with no turn for ARCHIVE_AFTER_DAYS are moved out of `messages` into
+# chat_archives as one compressed blob per chat. Reads decompress the blob;
+# the next turn in the chat moves its messages back (rehydrates it). Archived
+# messages stay in the search index, which keeps its own copy of the text.
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_CHATS = int(os.getenv("ARCHIVE_BATCH_CHATS", "100"))
+ARCHIVE_PAUSE_SECONDS = float(os.getenv("ARCHIVE_PAUSE_SECONDS", "0.01"))
+ARCHIVE_ZLIB_LEVEL = int(os.getenv("ARCHIVE_ZLIB_LEVEL", "6"))
+ARCHIVE_CACHE_SIZE = int(os.getenv("ARCHIVE_CACHE_SIZE", "64"))
+
+CODEC = "zlib"
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_CHATS = metrics.Counter("archive_chats_archived_total", "Chats moved into the archive.")
+ARCHIVED_RAW_BYTES = metrics.Counter("archive_raw_bytes_total", "Message text bytes moved into the archive.")
+ARCHIVED_STORED_BYTES = metrics.Counter("archive_stored_bytes_total", "Compressed bytes written to the archive.")
+REHYDRATE_SECONDS = metrics.Histogram("archive_rehydrate_seconds", "Time to move an archived chat back into messages.")
+READ_SECONDS = metrics.Histogram("archive_read_seconds", "Time to load and decompress an archived chat.")
+
+# Decompressed chats, keyed by (chatlogId, lastMessageId) so a later turn can
+# never be answered from a stale entry.
+_cache = LRUCache(ARCHIVE_CACHE_SIZE)
+_rehydrations = {"count": 0, "seconds": 0.0, "maxSeconds": 0.0}
+
+_worker = None
+
+
+def encode(messages) -> bytes:
+    rows = [[m["messageId"], m["sender"], m["messageContent"]] for m in messages]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), ARCHIVE_ZLIB_LEVEL)
+
+
+def decode(codec: str, data: bytes):
+    if codec != CODEC:
+        raise ValueError(f"Unknown archive codec {codec!r}")
+    return [
+        {"messageId": messageId, "sender": sender, "messageContent": content}
+        for messageId, sender, content in json.loads(zlib.decompress(data))
+    ]
+
+
+def load_messages(cursor, chatlogId: int, lastMessageId: int):
+    """Return an archived chat's messages, oldest first."""
+    key = (chatlogId, lastMessageId)
+    messages = _cache.get(key)
+    if messages is None:
+        started = time.perf_counter()
+        row = cursor.execute("SELECT codec, data FROM chat_archives WHERE chatlogId = ?", (chatlogId,)).fetchone()
+        messages = decode(row["codec"], row["data"]) if row else []
+        READ_SECONDS.observe(time.perf_counter() - started)
+        _cache.set(key, messages)
+    return messages
+
+
+def page(cursor, chatlogId: int, lastMessageId: int, before, after, limit: int):
+    """The archived equivalent of get_chat_messages' keyset queries: (messages, has_more)."""
+    messages = load_messages(cursor, chatlogId, lastMessageId)
+    ids = [m["messageId"] for m in messages]
+    if after is not None:
+        start = bisect.bisect_right(ids, after)
+        return messages[start:start + limit], len(messages) - start > limit
+    end = bisect.bisect_left(ids, before if before is not None else lastMessageId + 1)
+    return messages[max(end - limit, 0):end], end > limit
+
+
+def rehydrate(cursor, chatlogId: int) -> int:
+    """Move an archived chat's messages back into `messages`. Takes the write lock
+    if the caller hasn't; the caller commits."""
+    started = time.perf_counter()
+    if not cursor.connection.in_transaction:
+        cursor.execute("BEGIN IMMEDIATE")
+    row = cursor.execute("SELECT codec, data FROM chat_archives WHERE chatlogId = ?", (chatlogId,)).fetchone()
+    restored = 0
+    if row is not None:
+        messages = decode(row["codec"], row["data"])
+        cursor.executemany(
+            "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+            [(chatlogId, m["messageId"], m["sender"], m["messageContent"]) for m in messages]
+        )
+        cursor.execute("DELETE FROM chat_archives WHERE chatlogId = ?", (chatlogId,))
+        restored = len(messages)
+    cursor.execute("UPDATE chat_logs SET archivedAt = NULL WHERE chatlogId = ?", (chatlogId,))
+
+    elapsed = time.perf_counter() - started
+    REHYDRATE_SECONDS.observe(elapsed)
+    _rehydrations["count"] += 1
+    _rehydrations["seconds"] += elapsed
+    _rehydrations["maxSeconds"] = max(_rehydrations["maxSeconds"], elapsed)
+    return restored
+
+
+def _idle_modifier(days: float) -> str:
+    return f"-{days * 86400:.0f} seconds"
+
+
+def find_idle_chats(days: float, limit: int):
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute("""
+            SELECT chatlogId FROM chat_logs
+            WHERE archivedAt IS NULL AND deletedAt IS NULL AND lastActiveAt < datetime('now', ?) AND lastMessageId >= 0
+            ORDER BY lastActiveAt LIMIT ?
+        """, (_idle_modifier(days), limit))]
+
+
+def archive_chat(chatlogId: int, days: float):
+    """Archive one idle chat and return (rawBytes, storedBytes), or None if it
+    became active or was deleted in the meantime."""
+    with db.connection() as conn:
+        row = conn.execute("SELECT lastMessageId FROM chat_logs WHERE chatlogId = ?", (chatlogId,)).fetchone()
+        if row is None:
+            return None
+        messages = conn.execute(
+            "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? ORDER BY messageId",
+            (chatlogId,)
+        ).fetchall()
+        # Compress before taking the write lock; the check below catches turns that land meanwhile.
+        data = encode(messages)
+        raw_bytes = sum(len(m["messageContent"].encode("utf-8")) for m in messages)
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            still_idle = conn.execute("""
+                SELECT 1 FROM chat_logs
+                WHERE chatlogId = ? AND lastMessageId = ? AND archivedAt IS NULL AND deletedAt IS NULL
+                  AND lastActiveAt < datetime('now', ?)
+            """, (chatlogId, row["lastMessageId"], _idle_modifier(days))).fetchone()
+            if still_idle is None:
+                conn.rollback()
+                return None
+            conn.execute(
+                "INSERT INTO chat_archives (chatlogId, codec, messageCount, rawBytes, storedBytes, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (chatlogId, CODEC, len(messages), raw_bytes, len(data), data)
+            )
+            conn.execute("DELETE FROM messages WHERE chatlogId = ?", (chatlogId,))
+            conn.execute("UPDATE chat_logs SET archivedAt = CURRENT_TIMESTAMP WHERE chatlogId = ?", (chatlogId,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    ARCHIVED_CHATS.inc()
+    ARCHIVED_RAW_BYTES.inc(raw_bytes)
+    ARCHIVED_STORED_BYTES.inc(len(data))
+    return raw_bytes, len(data)
+
+
+async def archive_idle_chats(days: float = ARCHIVE_AFTER_DAYS, batch_chats: int = ARCHIVE_BATCH_CHATS):
+    """Archive every chat idle for `days`, one chat per transaction. Returns (chats, rawBytes, storedBytes)."""
+    chats = raw_bytes = stored_bytes = 0
+    while True:
+        chatlog_ids = await db.run(find_idle_chats, days, batch_chats)
+        if not chatlog_ids:
+            break
+        for chatlogId in chatlog_ids:
+            result = await db.run(archive_chat, chatlogId, days)
+            if result is not None:
+                chats += 1
+                raw_bytes += result[0]
+                stored_bytes += result[1]
+            # Give waiting writers a turn at the lock.
+            await asyncio.sleep(ARCHIVE_PAUSE_SECONDS)
+        if len(chatlog_ids) < batch_chats:
+            break
+    return chats, raw_bytes, stored_bytes
+
+
+def stats():
+    with db.connection() as conn:
+        row = conn.execute("""
+            SELECT COUNT(*) AS chats, IFNULL(SUM(messageCount), 0) AS messages,
+                   IFNULL(SUM(rawBytes), 0) AS rawBytes, IFNULL(SUM(storedBytes), 0) AS storedBytes
+            FROM chat_archives
+        """).fetchone()
+    result = dict(row)
+    result["savedBytes"] = result["rawBytes"] - result["storedBytes"]
+    result["ratio"] = round(result["rawBytes"] / result["storedBytes"], 2) if result["storedBytes"] else None
+    count = _rehydrations["count"]
+    result["rehydrations"] = {
+        "count": count,
+        "avgMs": round(_rehydrations["seconds"] / count * 1000, 3) if count else None,
+        "maxMs": round(_rehydrations["maxSeconds"] * 1000, 3),
+    }
+    return result
+
+
+async def _work():
+    while True:
+        try:
+            chats, raw_bytes, stored_bytes = await archive_idle_chats()
+            if chats:
+                logger.info("Archived %d idle chats, %d bytes stored as %d", chats, raw_bytes, stored_bytes)
+        except Exception:
+            logger.exception("Archive worker error")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+def start():
+    global _worker
+    if ARCHIVE_AFTER_DAYS > 0:
+        _worker = asyncio.create_task(_work())
+
+
+async def stop():
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _worker = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move idle chats into compressed cold storage.")
+    parser.add_argument("--run", action="store_true", help="Archive every chat idle for --days")
+    parser.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS)
+    args = parser.parse_args()
+    if not args.run:
+        parser.error("nothing to do; pass --run")
+
+    import migrations
+
+    migrations.migrate()
+    started = time.perf_counter()
+    chats, raw_bytes, stored_bytes = asyncio.run(archive_idle_chats(args.days))
+    print(f"Archived {chats} chats in {time.perf_counter() - started:.1f}s: {raw_bytes} bytes of messages stored as {stored_bytes}")
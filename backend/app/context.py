@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+
+import db
+import llm
+
+# Each chat turn sends the stored rolling summary plus the newest messages
+# that fit the token budget, so per-turn cost stays flat as a chat grows.
+# Once enough messages have slid out of the window they are folded into the
+# summary by a background task.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "8000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", "20"))
+SUMMARY_BATCH_MESSAGES = int(os.getenv("CHAT_SUMMARY_BATCH_MESSAGES", "6"))
+SUMMARY_MAX_WORDS = int(os.getenv("CHAT_SUMMARY_MAX_WORDS", "250"))
+# Each refresh folds at most this many tokens of messages into the summary; a
+# long backlog (e.g. an imported chat) is worked through over several turns.
+SUMMARY_CHUNK_TOKEN_BUDGET = int(os.getenv("CHAT_SUMMARY_CHUNK_TOKEN_BUDGET", "4000"))
+
+logger = logging.getLogger(__name__)
+
+_summary_model = None
+_summarizing = set()
+_tasks = set()
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English text.
+    return len(text) // 4 + 1
+
+
+@dataclass
+class ChatContext:
+    summary: str
+    summarized_through: int
+    # The newest messages that fit the budget, oldest first.
+    window: list
+    # Older messages that are neither in the window nor in the summary yet.
+    pending: int
+
+    @property
+    def needs_summary(self) -> bool:
+        return self.pending >= SUMMARY_BATCH_MESSAGES
+
+    def history_for_model(self):
+        history = []
+        if self.summary:
+            history.append({"role": "user", "parts": [f"Summary of our earlier conversation: {self.summary}"]})
+            history.append({"role": "model", "parts": ["Understood, I will keep that context in mind."]})
+        for message in self.window:
+            role = "model" if message["sender"] == "llm" else "user"
+            history.append({"role": role, "parts": [message["messageContent"]]})
+        return history
+
+
+def _build_context(summary, summarized_through, newest_first) -> ChatContext:
+    budget = CONTEXT_TOKEN_BUDGET - (estimate_tokens(summary) if summary else 0)
+    window = []
+    for message in newest_first:
+        budget -= estimate_tokens(message["messageContent"])
+        if budget < 0 and window:
+            break
+        window.append(message)
+    window.reverse()
+
+    # Keep the window starting on a user turn so the history alternates cleanly.
+    if window and window[0]["sender"] == "llm":
+        window = window[1:]
+
+    if window:
+        pending = window[0]["messageId"] - summarized_through - 1
+    else:
+        pending = len(newest_first)
+    return ChatContext(summary, summarized_through, window, pending)
+
+
+def load_context(cursor, chatlogId) -> ChatContext:
+    cursor.execute("SELECT summary, summarizedThroughId FROM chat_logs WHERE chatlogId = ?", (chatlogId,))
+    row = cursor.fetchone()
+    summary = row["summary"] if row else None
+    summarized_through = row["summarizedThroughId"] if row and row["summarizedThroughId"] is not None else -1
+
+    cursor.execute(
+        "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? AND messageId > ? ORDER BY messageId DESC LIMIT ?",
+        (chatlogId, summarized_through, CONTEXT_MAX_MESSAGES)
+    )
+    return _build_context(summary, summarized_through, cursor.fetchall())
+
+
+def load_contexts(cursor, chat_rows) -> dict:
+    """Load the contexts of several chats with one query. chat_rows need chatlogId,
+    summary and summarizedThroughId; returns {chatlogId: ChatContext}."""
+    if not chat_rows:
+        return {}
+    through = {
+        row["chatlogId"]: row["summarizedThroughId"] if row["summarizedThroughId"] is not None else -1
+        for row in chat_rows
+    }
+    # One LIMITed seek per chat on the primary key, combined into a single statement.
+    selects = " UNION ALL ".join(
+        "SELECT * FROM (SELECT chatlogId, messageId, sender, messageContent FROM messages "
+        "WHERE chatlogId = ? AND messageId > ? ORDER BY messageId DESC LIMIT ?)"
+        for _ in through
+    )
+    params = [value for chatlogId, summarized_through in through.items() for value in (chatlogId, summarized_through, CONTEXT_MAX_MESSAGES)]
+    newest_first = {chatlogId: [] for chatlogId in through}
+    for message in cursor.execute(selects, params):
+        newest_first[message["chatlogId"]].append(message)
+    for messages in newest_first.values():
+        messages.sort(key=lambda message: message["messageId"], reverse=True)
+
+    return {
+        row["chatlogId"]: _build_context(row["summary"], through[row["chatlogId"]], newest_first[row["chatlogId"]])
+        for row in chat_rows
+    }
+
+
+def _pending_messages(chatlogId):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        ctx = load_context(cursor, chatlogId)
+        if ctx.pending <= 0:
+            return ctx, []
+
+        cursor.execute(
+            "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? AND messageId > ? AND messageId <= ? ORDER BY messageId ASC",
+            (chatlogId, ctx.summarized_through, ctx.summarized_through + ctx.pending)
+        )
+        messages = []
+        budget = SUMMARY_CHUNK_TOKEN_BUDGET
+        for message in cursor:
+            tokens = estimate_tokens(message["messageContent"])
+            if tokens > budget:
+                if messages:
+                    break
+                # A single message over the budget is folded in cut short rather than never.
+                message = {**dict(message), "messageContent": message["messageContent"][:budget * 4]}
+            messages.append(message)
+            budget -= tokens
+        return ctx, messages
+
+
+def _store_summary(chatlogId, summary, previous_through, summarized_through):
+    with db.connection() as conn:
+        # Only apply if nobody else moved the summary forward in the meantime.
+        conn.execute(
+            "UPDATE chat_logs SET summary = ?, summarizedThroughId = ? WHERE chatlogId = ? AND IFNULL(summarizedThroughId, -1) = ?",
+            (summary, summarized_through, chatlogId, previous_through)
+        )
+        conn.commit()
+
+
+async def refresh_summary(chatlogId):
+    global _summary_model
+    ctx, messages = await db.run(_pending_messages, chatlogId)
+    if not messages:
+        return
+
+    transcript = "\n".join(
+        f"{'Assistant' if m['sender'] == 'llm' else 'User'}: {m['messageContent']}" for m in messages
+    )
+    prompt = (
+        f"Update the running summary of a conversation. Keep it under {SUMMARY_MAX_WORDS} words and "
+        "preserve facts, decisions and open questions.\n\n"
+        f"Current summary:\n{ctx.summary or '(none)'}\n\nNew messages:\n{transcript}"
+    )
+
+    if _summary_model is None:
+        _summary_model = llm.build_summary_model()
+    response = await llm.generate(_summary_model, prompt)
+    await db.run(_store_summary, chatlogId, response.text, ctx.summarized_through, messages[-1]["messageId"])
+
+
+async def _run_refresh(chatlogId):
+    try:
+        await refresh_summary(chatlogId)
+    except Exception:
+        # The next turn will try again; the window still covers recent context.
+        logger.exception("Failed to refresh summary for chat %s", chatlogId)
+    finally:
+        _summarizing.discard(chatlogId)
+
+
+def schedule_summary(chatlogId):
+    """Refresh a chat's summary in the background, at most once at a time per chat."""
+    if chatlogId in _summarizing:
+        return
+    _summarizing.add(chatlogId)
+    task = asyncio.create_task(_run_refresh(chatlogId))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -0,0 +1,111 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+
+# Shared data-access layer. Connections are opened once, tuned once and then
+# reused by every request instead of paying sqlite3.connect on each call.
+DB_PATH = Path(os.getenv("DB_PATH", Path(__file__).parent.resolve() / "database.db"))
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+POOL_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "10"))
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+
+def _open_connection(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+
+class ConnectionPool:
+    """A bounded pool of SQLite connections that can be shared across threads."""
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return _open_connection(self.path)
+            except sqlite3.Error:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a free database connection")
+
+    def release(self, conn: sqlite3.Connection):
+        # Never hand a half-finished transaction to the next request.
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put_nowait(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+pool = ConnectionPool(DB_PATH, POOL_SIZE)
+
+metrics.Gauge("db_pool_connections_open", "SQLite connections opened by the pool.", lambda: pool._opened)
+metrics.Gauge("db_pool_connections_idle", "Pooled SQLite connections not in use.", lambda: pool._idle.qsize())
+
+
+def connect() -> sqlite3.Connection:
+    return pool.acquire()
+
+
+def release(conn: sqlite3.Connection):
+    pool.release(conn)
+
+
+@contextmanager
+def connection():
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+async def run(func, *args, **kwargs):
+    """Run blocking database work on the threadpool instead of the event loop."""
+    return await run_in_threadpool(func, *args, **kwargs)
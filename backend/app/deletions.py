@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+
+import db
+
+# Deleting a profile or chat only marks it deleted and queues a job. A
+# background worker then removes the rows in small batches, committing after
+# each one so SQLite's write lock is released between batches and concurrent
+# chat turns are never stuck behind one long delete.
+DELETE_BATCH_SIZE = int(os.getenv("DELETE_BATCH_SIZE", "500"))
+DELETE_BATCH_PAUSE_SECONDS = float(os.getenv("DELETE_BATCH_PAUSE_SECONDS", "0.01"))
+DELETE_POLL_SECONDS = float(os.getenv("DELETE_POLL_SECONDS", "5"))
+
+logger = logging.getLogger(__name__)
+
+_wakeup = None
+_loop = None
+_worker = None
+
+
+def enqueue_profile(cursor, userId: str, profileId: int) -> int:
+    cursor.execute(
+        "INSERT INTO deletion_jobs (kind, userId, profileId) VALUES ('profile', ?, ?)",
+        (userId, profileId)
+    )
+    return cursor.lastrowid
+
+
+def enqueue_chat(cursor, userId: str, chatlogId: int) -> int:
+    cursor.execute(
+        "INSERT INTO deletion_jobs (kind, userId, chatlogId) VALUES ('chat', ?, ?)",
+        (userId, chatlogId)
+    )
+    return cursor.lastrowid
+
+
+def get_job(jobId: int, userId: str):
+    with db.connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM deletion_jobs WHERE jobId = ? AND userId = ?", (jobId, userId)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def _next_job():
+    with db.connection() as conn:
+        # Jobs left 'running' by a restart are picked up again.
+        row = conn.execute("""
+            SELECT * FROM deletion_jobs WHERE status IN ('pending', 'running')
+            ORDER BY jobId LIMIT 1
+        """).fetchone()
+        if row is None:
+            return None, []
+
+        if row["kind"] == "profile":
+            chatlog_ids = [r[0] for r in conn.execute(
+                "SELECT chatlogId FROM chat_logs WHERE userId = ? AND profileId = ?",
+                (row["userId"], row["profileId"])
+            )]
+        else:
+            chatlog_ids = [row["chatlogId"]]
+
+        if row["status"] == "pending":
+            total = sum(
+                conn.execute("SELECT COUNT(*) FROM messages WHERE chatlogId = ?", (cid,)).fetchone()[0]
+                for cid in chatlog_ids
+            )
+            conn.execute(
+                "UPDATE deletion_jobs SET status = 'running', totalMessages = ? WHERE jobId = ?",
+                (total, row["jobId"])
+            )
+            conn.commit()
+        return dict(row), chatlog_ids
+
+
+def _delete_message_batch(jobId: int, chatlogId: int) -> int:
+    with db.connection() as conn:
+        cursor = conn.execute("""
+            DELETE FROM messages WHERE chatlogId = ? AND messageId IN (
+                SELECT messageId FROM messages WHERE chatlogId = ? ORDER BY messageId LIMIT ?
+            )
+        """, (chatlogId, chatlogId, DELETE_BATCH_SIZE))
+        deleted = cursor.rowcount
+        conn.execute(
+            "UPDATE deletion_jobs SET deletedMessages = deletedMessages + ? WHERE jobId = ?",
+            (deleted, jobId)
+        )
+        conn.commit()
+    return deleted
+
+
+def _finish_job(job, chatlog_ids):
+    with db.connection() as conn:
+        conn.executemany("DELETE FROM chat_logs WHERE chatlogId = ?", [(cid,) for cid in chatlog_ids])
+        if job["kind"] == "profile":
+            conn.execute(
+                "DELETE FROM model_profiles WHERE userId = ? AND profileId = ?",
+                (job["userId"], job["profileId"])
+            )
+        conn.execute(
+            "UPDATE deletion_jobs SET status = 'done', finishedAt = CURRENT_TIMESTAMP WHERE jobId = ?",
+            (job["jobId"],)
+        )
+        conn.commit()
+
+
+def _fail_job(jobId: int, error: str):
+    with db.connection() as conn:
+        conn.execute(
+            "UPDATE deletion_jobs SET status = 'failed', error = ?, finishedAt = CURRENT_TIMESTAMP WHERE jobId = ?",
+            (error, jobId)
+        )
+        conn.commit()
+
+
+async def run_pending_jobs():
+    while True:
+        job, chatlog_ids = await db.run(_next_job)
+        if job is None:
+            return
+        try:
+            for chatlogId in chatlog_ids:
+                while await db.run(_delete_message_batch, job["jobId"], chatlogId) > 0:
+                    # Give waiting writers a turn at the lock.
+                    await asyncio.sleep(DELETE_BATCH_PAUSE_SECONDS)
+            await db.run(_finish_job, job, chatlog_ids)
+        except Exception as e:
+            logger.exception("Deletion job %s failed", job["jobId"])
+            await db.run(_fail_job, job["jobId"], str(e))
+
+
+async def _work():
+    while True:
+        try:
+            await run_pending_jobs()
+        except Exception:
+            logger.exception("Deletion worker error")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), DELETE_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+
+def wake():
+    """Tell the worker new jobs are queued. Safe to call from any thread."""
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+
+def start():
+    global _wakeup, _loop, _worker
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    _worker = asyncio.create_task(_work())
+
+
+async def stop():
+    global _worker, _loop
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _worker = None
+    _loop = None
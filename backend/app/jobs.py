@@ -0,0 +1,277 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+from fastapi import HTTPException
+
+import db
+import llm
+import metrics
+
+# Chat prompts submitted as jobs are stored in llm_jobs and answered by a pool
+# of worker tasks, so the client can disconnect and poll for the result. A
+# claimed job holds a lease; if its process dies the lease runs out and any
+# process's workers pick it up again. Failures with a retryable status are
+# retried with jittered exponential backoff.
+LLM_JOB_WORKERS = int(os.getenv("LLM_JOB_WORKERS", "4"))
+LLM_JOB_MAX_ATTEMPTS = int(os.getenv("LLM_JOB_MAX_ATTEMPTS", "3"))
+LLM_JOB_RETRY_BASE_SECONDS = float(os.getenv("LLM_JOB_RETRY_BASE_SECONDS", "2"))
+LLM_JOB_LEASE_SECONDS = float(os.getenv("LLM_JOB_LEASE_SECONDS", str(llm.LLM_TIMEOUT_SECONDS + 60)))
+LLM_JOB_POLL_SECONDS = float(os.getenv("LLM_JOB_POLL_SECONDS", "1"))
+LLM_JOB_WAIT_MAX_SECONDS = 30
+LLM_JOB_RETENTION_HOURS = float(os.getenv("LLM_JOB_RETENTION_HOURS", "168"))
+LLM_JOB_PRUNE_INTERVAL_SECONDS = 3600
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+PUBLIC_FIELDS = ("jobId", "chatlogId", "status", "attempts", "response", "error", "errorStatus", "createdAt", "finishedAt")
+
+logger = logging.getLogger(__name__)
+
+JOBS = metrics.Counter("llm_jobs_total", "LLM job attempts by outcome.", ["outcome"])
+
+_running = 0
+metrics.Gauge("llm_jobs_running", "LLM jobs being answered by this process.", lambda: _running)
+
+_wakeup = None
+_loop = None
+_workers = []
+_waiters = {}
+_last_prune = 0.0
+
+
+def public(job):
+    return {field: job[field] for field in PUBLIC_FIELDS}
+
+
+def submit(userId: str, chatlogId: int, prompt: str, idempotency_key=None):
+    """Queue a prompt and return (job, created). With an idempotency key, a repeat
+    of an earlier submission returns that job instead of queueing another."""
+    if idempotency_key is not None:
+        existing = get_by_key(userId, idempotency_key)
+        if existing is not None:
+            return _replay(existing, chatlogId, prompt), False
+
+    with db.connection() as conn:
+        owned = conn.execute(
+            "SELECT 1 FROM chat_logs WHERE chatlogId = ? AND userId = ? AND deletedAt IS NULL", (chatlogId, userId)
+        ).fetchone()
+        if owned is None:
+            raise HTTPException(status_code=404, detail=f"Chat log with ID {chatlogId} not found")
+
+        # Two concurrent submissions with the same key race here; the loser gets no row back.
+        job = conn.execute("""
+            INSERT INTO llm_jobs (userId, chatlogId, prompt, idempotencyKey) VALUES (?, ?, ?, ?)
+            ON CONFLICT (userId, idempotencyKey) DO NOTHING
+            RETURNING *
+        """, (userId, chatlogId, prompt, idempotency_key)).fetchone()
+        conn.commit()
+    if job is None:
+        return _replay(get_by_key(userId, idempotency_key), chatlogId, prompt), False
+    wake()
+    return dict(job), True
+
+
+def get_by_key(userId: str, idempotency_key: str):
+    with db.connection() as conn:
+        row = conn.execute(
+            "SELECT * FROM llm_jobs WHERE userId = ? AND idempotencyKey = ?", (userId, idempotency_key)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def _replay(existing, chatlogId, prompt):
+    if existing["chatlogId"] != chatlogId or existing["prompt"] != prompt:
+        raise HTTPException(status_code=409, detail="Idempotency key was already used for a different request")
+    return existing
+
+
+def get_job(jobId: int, userId: str):
+    with db.connection() as conn:
+        row = conn.execute("SELECT * FROM llm_jobs WHERE jobId = ? AND userId = ?", (jobId, userId)).fetchone()
+    return dict(row) if row else None
+
+
+async def wait(jobId: int, userId: str, timeout: float):
+    """Return the job once it has finished or `timeout` seconds have passed.
+    Jobs finished by this process wake the waiter at once; others are seen by polling."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        job = await db.run(get_job, jobId, userId)
+        remaining = deadline - loop.time()
+        if job is None or job["status"] in ("done", "failed") or remaining <= 0:
+            return job
+        # [event, number of waiters]; the last waiter to leave removes the entry
+        entry = _waiters.setdefault(jobId, [asyncio.Event(), 0])
+        entry[1] += 1
+        try:
+            await asyncio.wait_for(entry[0].wait(), min(remaining, LLM_JOB_POLL_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            entry[1] -= 1
+            if not entry[1] and _waiters.get(jobId) is entry:
+                del _waiters[jobId]
+
+
+def _notify(jobId: int):
+    entry = _waiters.pop(jobId, None)
+    if entry is not None:
+        entry[0].set()
+
+
+def _claim():
+    now = time.time()
+    with db.connection() as conn:
+        row = conn.execute("""
+            UPDATE llm_jobs SET status = 'running', attempts = attempts + 1, leaseExpiresAt = ?
+            WHERE jobId = (
+                SELECT jobId FROM llm_jobs
+                WHERE status IN ('queued', 'running')
+                  AND ((status = 'queued' AND runAfter <= ?) OR (status = 'running' AND leaseExpiresAt < ?))
+                ORDER BY jobId LIMIT 1
+            )
+            RETURNING *
+        """, (now + LLM_JOB_LEASE_SECONDS, now, now)).fetchone()
+        conn.commit()
+    return dict(row) if row else None
+
+
+def mark_done(cursor, job, response: str) -> bool:
+    """Record a job's answer in the caller's transaction, so the answer and the
+    chat turn it produced are committed together. Returns False if this worker
+    no longer holds the job, in which case the caller must roll back."""
+    cursor.execute("""
+        UPDATE llm_jobs SET status = 'done', response = ?, error = NULL, errorStatus = NULL,
+            leaseExpiresAt = NULL, finishedAt = CURRENT_TIMESTAMP
+        WHERE jobId = ? AND status = 'running' AND attempts = ?
+    """, (response, job["jobId"], job["attempts"]))
+    return cursor.rowcount == 1
+
+
+def _record_failure(job, status: int, detail: str, retry_after: float):
+    with db.connection() as conn:
+        if retry_after is not None:
+            conn.execute("""
+                UPDATE llm_jobs SET status = 'queued', runAfter = ?, leaseExpiresAt = NULL, error = ?, errorStatus = ?
+                WHERE jobId = ? AND status = 'running' AND attempts = ?
+            """, (time.time() + retry_after, detail, status, job["jobId"], job["attempts"]))
+        else:
+            conn.execute("""
+                UPDATE llm_jobs SET status = 'failed', leaseExpiresAt = NULL, error = ?, errorStatus = ?,
+                    finishedAt = CURRENT_TIMESTAMP
+                WHERE jobId = ? AND status = 'running' AND attempts = ?
+            """, (detail, status, job["jobId"], job["attempts"]))
+        conn.commit()
+
+
+def _release(job):
+    # Put a job interrupted by shutdown back without using up an attempt.
+    with db.connection() as conn:
+        conn.execute("""
+            UPDATE llm_jobs SET status = 'queued', attempts = attempts - 1, leaseExpiresAt = NULL
+            WHERE jobId = ? AND status = 'running' AND attempts = ?
+        """, (job["jobId"], job["attempts"]))
+        conn.commit()
+
+
+def _backoff(attempts: int, headers) -> float:
+    delay = LLM_JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+    retry_after = (headers or {}).get("Retry-After")
+    if retry_after is not None:
+        delay = max(delay, float(retry_after))
+    return delay
+
+
+def _prune():
+    with db.connection() as conn:
+        conn.execute(
+            "DELETE FROM llm_jobs WHERE status IN ('done', 'failed') AND finishedAt < datetime('now', ?)",
+            (f"-{LLM_JOB_RETENTION_HOURS * 3600:.0f} seconds",)
+        )
+        conn.commit()
+
+
+async def _run(handler, job):
+    global _running
+    if job["attempts"] > LLM_JOB_MAX_ATTEMPTS:
+        # Its last lease ran out, e.g. the process answering it died.
+        await db.run(_record_failure, job, 500, job["error"] or "Job was abandoned by its worker", None)
+        JOBS.inc(outcome="failed")
+        _notify(job["jobId"])
+        return
+
+    _running += 1
+    try:
+        with metrics.span("jobs.run"):
+            await handler(job)
+        JOBS.inc(outcome="done")
+    except asyncio.CancelledError:
+        await db.run(_release, job)
+        raise
+    except Exception as e:
+        status = e.status_code if isinstance(e, HTTPException) else 500
+        detail = e.detail if isinstance(e, HTTPException) else f"Job failed: {e}"
+        retry_after = None
+        if status in RETRYABLE_STATUSES and job["attempts"] < LLM_JOB_MAX_ATTEMPTS:
+            retry_after = _backoff(job["attempts"], getattr(e, "headers", None))
+        if not isinstance(e, HTTPException):
+            logger.exception("LLM job %s failed", job["jobId"])
+        await db.run(_record_failure, job, status, str(detail), retry_after)
+        JOBS.inc(outcome="retried" if retry_after is not None else "failed")
+    finally:
+        _running -= 1
+    _notify(job["jobId"])
+
+
+async def _work(handler, index):
+    global _last_prune
+    while True:
+        try:
+            job = await db.run(_claim)
+            if job is not None:
+                await _run(handler, job)
+                continue
+            if index == 0 and time.monotonic() - _last_prune >= LLM_JOB_PRUNE_INTERVAL_SECONDS:
+                _last_prune = time.monotonic()
+                await db.run(_prune)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("LLM job worker error")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), LLM_JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+
+def wake():
+    """Tell the workers a job is queued. Safe to call from any thread."""
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+
+def start(handler):
+    """Start LLM_JOB_WORKERS workers that answer each job with `await handler(job)`.
+    The handler saves its result with mark_done and raises to fail the attempt."""
+    global _wakeup, _loop
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    for index in range(LLM_JOB_WORKERS):
+        _workers.append(asyncio.create_task(_work(handler, index)))
+
+
+async def stop():
+    global _loop
+    for worker in _workers:
+        worker.cancel()
+    for worker in _workers:
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+    _workers.clear()
+    _loop = None
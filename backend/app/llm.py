@@ -0,0 +1,237 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+import admission
+import metrics
+import providers
+import resilience
+
+# Every Gemini call goes through here so a slow model response only ties up
+# one concurrency slot instead of the whole event loop.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_MAX_QUEUE_PER_USER = int(os.getenv("LLM_MAX_QUEUE_PER_USER", "8"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_RETRY_AFTER_SECONDS = int(os.getenv("LLM_RETRY_AFTER_SECONDS", "5"))
+LLM_WARM_UP = os.getenv("LLM_WARM_UP", "1") == "1"
+
+MODEL_NAME = "gemini-2.5-flash"
+GENERATION_CONFIG = {"temperature": 0.2}
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_SECONDS = metrics.Histogram("llm_queue_wait_seconds", "Time LLM calls waited for a concurrency slot.", ["tier"])
+
+
+class FairLimiter:
+    """Caps in-flight LLM calls and queues the rest fairly between users.
+
+    Waiters are served in order of a virtual finish tag: each user's next request
+    is tagged 1/weight after the later of their previous request and the request
+    last served, so a user with many queued requests waits behind everyone else's
+    first one, and a tier with twice the weight gets twice the share. Calls made
+    outside admission.admit/bind are queued together under one anonymous key."""
+
+    def __init__(self, max_concurrency: int, max_queue: int, max_queue_per_user: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.active = 0
+        self.waiting = 0
+        self.queued = {}
+        self.queued_by_tier = {}
+        self._heap = []
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+    def _reject(self, detail: str):
+        raise HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(LLM_RETRY_AFTER_SECONDS)}
+        )
+
+    async def acquire(self):
+        """Wait for a slot and return an idempotent function that frees it."""
+        # Don't queue for an upstream that is known to be down.
+        resilience.breaker.check()
+        caller = admission.current()
+        key, tier, weight = (caller.userId, caller.tier, caller.weight) if caller else (None, "none", 1)
+
+        if self.active >= self.max_concurrency or self.waiting:
+            if self.waiting >= self.max_queue:
+                self._reject("Too many LLM requests in progress. Please retry shortly.")
+            if self.queued.get(key, 0) >= self.max_queue_per_user:
+                self._reject("You have too many LLM requests waiting. Please retry shortly.")
+            await self._wait(key, tier, weight)
+        else:
+            self.active += 1
+            QUEUE_WAIT_SECONDS.observe(0, tier=tier)
+        return self._releaser()
+
+    def try_acquire(self):
+        """Take a slot only if one is free and nobody is waiting; returns a release function or None."""
+        if self.active >= self.max_concurrency or self.waiting:
+            return None
+        self.active += 1
+        return self._releaser()
+
+    def _releaser(self):
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self._hand_off()
+
+        return release
+
+    async def _wait(self, key, tier, weight):
+        loop = asyncio.get_running_loop()
+        tag = max(self._virtual_time, self._finish_tags.get(key, 0.0)) + 1 / weight
+        self._finish_tags[key] = tag
+        future = loop.create_future()
+        heapq.heappush(self._heap, (tag, next(self._seq), future))
+        self.waiting += 1
+        self.queued[key] = self.queued.get(key, 0) + 1
+        self.queued_by_tier[tier] = self.queued_by_tier.get(tier, 0) + 1
+        started = loop.time()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled just after being handed a slot: pass it on.
+            if future.done() and not future.cancelled():
+                self._hand_off()
+            raise
+        finally:
+            self.waiting -= 1
+            self.queued_by_tier[tier] -= 1
+            self.queued[key] -= 1
+            if not self.queued[key]:
+                del self.queued[key]
+                del self._finish_tags[key]
+        QUEUE_WAIT_SECONDS.observe(loop.time() - started, tier=tier)
+
+    def _hand_off(self):
+        # Give a freed slot straight to the next live waiter, or free it.
+        while self._heap:
+            tag, _, future = heapq.heappop(self._heap)
+            if not future.done():
+                self._virtual_time = tag
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+limiter = FairLimiter(LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_MAX_QUEUE_PER_USER)
+
+metrics.Gauge("llm_requests_active", "LLM calls currently holding a concurrency slot.", lambda: limiter.active)
+metrics.Gauge("llm_requests_waiting", "LLM calls waiting for a concurrency slot.", lambda: limiter.waiting)
+metrics.Gauge(
+    "llm_queue_depth", "LLM calls waiting for a concurrency slot, by tier.",
+    lambda: {(tier,): count for tier, count in limiter.queued_by_tier.items()}, ["tier"]
+)
+
+
+def queue_stats():
+    return {
+        "active": limiter.active,
+        "maxConcurrency": limiter.max_concurrency,
+        "waiting": limiter.waiting,
+        "maxQueue": limiter.max_queue,
+        "maxQueuePerUser": limiter.max_queue_per_user,
+        "waitingByTier": {tier: count for tier, count in limiter.queued_by_tier.items() if count},
+        "waitingUsers": sum(1 for key in limiter.queued if key is not None),
+    }
+
+
+def build_model(system_prompt: str):
+    return providers.get().build_model(MODEL_NAME, system_prompt, GENERATION_CONFIG)
+
+
+def build_summary_model():
+    return providers.get().build_model(MODEL_NAME, generation_config=GENERATION_CONFIG)
+
+
+async def warm_up():
+    """Create the provider in a worker thread so the first chat request doesn't
+    pay for importing the SDK. Failures are retried on first use."""
+    if not LLM_WARM_UP:
+        return
+    try:
+        await run_in_threadpool(providers.get)
+    except Exception:
+        logger.exception("LLM provider warm-up failed")
+
+
+def _timeout_error():
+    return HTTPException(status_code=504, detail=f"LLM did not respond within {LLM_TIMEOUT_SECONDS:g} seconds")
+
+
+def _deadline():
+    return asyncio.get_running_loop().time() + LLM_TIMEOUT_SECONDS
+
+
+async def send_message(chat_session, prompt: str):
+    with metrics.span("llm.queue_wait"):
+        release = await limiter.acquire()
+    try:
+        # Chat sessions are rebuilt for every turn, so a hedged duplicate can't corrupt a shared history.
+        with metrics.span("llm.send_message"):
+            response = await resilience.call(
+                lambda: chat_session.send_message_async(prompt), _deadline(), limiter.try_acquire
+            )
+        metrics.record_usage(response)
+        admission.settle(response)
+        return response
+    except asyncio.TimeoutError:
+        raise _timeout_error()
+    finally:
+        release()
+
+
+async def generate(model, contents):
+    release = await limiter.acquire()
+    try:
+        with metrics.span("llm.generate_content"):
+            response = await resilience.call(lambda: model.generate_content_async(contents), _deadline())
+        metrics.record_usage(response)
+        admission.settle(response)
+        return response
+    except asyncio.TimeoutError:
+        raise _timeout_error()
+    finally:
+        release()
+
+
+async def stream_message(chat_session, prompt: str):
+    """Yield response chunks as they arrive. The caller must already hold a limiter slot."""
+    loop = asyncio.get_running_loop()
+    deadline = _deadline()
+    try:
+        # Only starting the stream is retried; once chunks have been sent a retry would repeat them.
+        with metrics.span("llm.stream_first_chunk"):
+            response = await resilience.call(lambda: chat_session.send_message_async(prompt, stream=True), deadline)
+        chunks = aiter(response)
+        last_chunk = None
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), max(deadline - loop.time(), 0))
+            except StopAsyncIteration:
+                # Gemini reports cumulative usage on the final chunk.
+                metrics.record_usage(last_chunk)
+                admission.settle(last_chunk)
+                return
+            last_chunk = chunk
+            yield chunk
+    except asyncio.TimeoutError:
+        raise _timeout_error()
@@ -1,39 +1,74 @@
-from fastapi import FastAPI,HTTPException, status, Depends, Body
+from fastapi import FastAPI,HTTPException, status, Depends, Body, Request, Response, Query, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse, ORJSONResponse
+from starlette.background import BackgroundTask
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from pydantic import BaseModel, EmailStr
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
-import google.generativeai as genai
+from typing import Optional
 from dotenv import load_dotenv
 import os
 import json
+import asyncio
+import logging
+import time
 import sqlite3
+import db
+import llm
+import admission
+import providers
+import ruleset_store
+import context
+import passwords
+import migrations
+import deletions
+import response_cache
+import metrics
+import search
+import archive
+import jobs
+import transfer
+from cache import LRUCache
 from pathlib import Path
+from contextlib import asynccontextmanager
+
+# orjson is optional; it serializes large payloads such as /workspace several times faster
+try:
+    import orjson  # noqa: F401
+    FastJSONResponse = ORJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
 
 # Construct path to .env file relative to the script's location
 dotenv_path = Path(__file__).parent.resolve() / '.env'
 load_dotenv(dotenv_path=dotenv_path)
-api_key = os.getenv("API_KEY")
-if api_key is None:
-    raise ValueError("API_KEY environment variable not set")
 
-genai.configure(api_key=api_key)
+logger = logging.getLogger(__name__)
 
-# Define an absolute path to the 'rulesets' directory and database
-APP_ROOT = Path(__file__).parent.resolve()
-UPLOAD_DIR = APP_ROOT / "rulesets"
+# Define an absolute path to the 'rulesets' directory
+UPLOAD_DIR = ruleset_store.UPLOAD_DIR
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-DB_PATH = APP_ROOT / "database.db"
 
-def count_files_in_directory(directory: str):
-    return len([
-        f for f in os.listdir(directory)
-        if os.path.isfile(os.path.join(directory, f))
-    ])
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    providers.check_config()
+    # The LLM SDK loads in the background; startup doesn't wait for it.
+    warm_up = asyncio.create_task(llm.warm_up())
+    await db.run(migrations.migrate)
+    deletions.start()
+    archive.start()
+    jobs.start(run_chat_job)
+    yield
+    await warm_up
+    await jobs.stop()
+    await archive.stop()
+    await deletions.stop()
+    passwords.shutdown()
+    db.pool.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 class User(BaseModel):
@@ -55,14 +90,6 @@ class Token(BaseModel):
     # token_type: str
     id: str
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
-def hashed_password(password: str) -> str:
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hash_password: str) -> bool:
-    return pwd_context.verify(plain_password, hash_password)
-
 secret_key = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 1440
@@ -81,66 +108,107 @@ def read_root():
 def hello():
     return {"message": "Hello from FastAPI 🚀"}
 
-@app.post("/register", response_model=Token)
-def register(user: User):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT email FROM users WHERE email = ?", (user.email,))
-    if cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Email already registered")
+def find_user_by_email(email: str):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
+        return cursor.fetchone()
 
-    hashed_pwd = hashed_password(user.password)
-    try:
+def find_user_by_username(username: str):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
+        return cursor.fetchone()
+
+def insert_user(username: str, email: str, hashed_pwd: str):
+    with db.connection() as conn:
+        cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO users (username, email, hashed_pass) VALUES (?, ?, ?)",
-            (user.username, user.email, hashed_pwd)
+            (username, email, hashed_pwd)
         )
         conn.commit()
+
+def update_password_hash(email: str, hashed_pwd: str):
+    with db.connection() as conn:
+        conn.execute("UPDATE users SET hashed_pass = ? WHERE email = ?", (hashed_pwd, email))
+        conn.commit()
+
+@app.post("/register", response_model=Token)
+async def register(user: User):
+    if await db.run(find_user_by_email, user.email):
+        raise HTTPException(status_code=400, detail="Email already registered")
+
+    hashed_pwd = await passwords.hash_password(user.password)
+    try:
+        await db.run(insert_user, user.username, user.email, hashed_pwd)
     except sqlite3.Error as e:
-        conn.close()
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
-    finally:
-        conn.close()
 
     access_token = create_access_token(data={"sub": user.email})
     return {"id": user.username, "token": access_token}
 
 @app.post("/login", response_model=Token)
-def login(user_credentials: UserLogin):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE email = ?", (user_credentials.email,))
-    user_in_db = cursor.fetchone()
-    conn.close()
-
-    if not user_in_db or not verify_password(user_credentials.password, user_in_db["hashed_pass"]):
+async def login(user_credentials: UserLogin):
+    user_in_db = await db.run(find_user_by_email, user_credentials.email)
+    if not user_in_db:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    valid, new_hash = await passwords.verify_password(user_credentials.password, user_in_db["hashed_pass"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    # The stored hash used a different cost factor; upgrade it while we have the password.
+    if new_hash:
+        try:
+            await db.run(update_password_hash, user_in_db["email"], new_hash)
+            invalidate_user_sessions(user_in_db["email"])
+        except sqlite3.Error:
+            pass
+
     access_token = create_access_token(data={"sub": user_in_db["email"]})
     return {"token": access_token, "id": user_in_db["username"]}
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
+# Verified tokens map straight to their user record so authenticated requests
+# skip the JWT decode and the users lookup. Entries never outlive the token.
+# Changes made in this process call invalidate_user_sessions; changes made
+# elsewhere (admission.py --set-tier, other workers) show within the TTL.
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+auth_cache = LRUCache(AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL_SECONDS)
+AUTH_CACHE_LOOKUPS = metrics.Counter("auth_cache_lookups_total", "Token lookups in the auth cache.", ["result"])
+
+def invalidate_user_sessions(email: str):
+    """Forget cached tokens for a user. Call after changing any field of their users row."""
+    auth_cache.discard_where(lambda user: user["email"] == email)
+
 def get_current_user(token: str = Depends(oauth2_scheme)):
+    cached_user = auth_cache.get(token)
+    if cached_user is not None:
+        AUTH_CACHE_LOOKUPS.inc(result="hit")
+        return cached_user
+    AUTH_CACHE_LOOKUPS.inc(result="miss")
+
     try:
-        payload = jwt.decode(token, secret_key, algorithms=[ALGORITHM])
+        with metrics.span("auth.decode_token"):
+            payload = jwt.decode(token, secret_key, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise HTTPException(status_code=401, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-    user = cursor.fetchone()
-    conn.close()
-
+    with metrics.span("auth.user_lookup"):
+        user = find_user_by_email(email)
     if user is None:
         raise HTTPException(status_code=401, detail="Invalid token")
+
+    user = dict(user)
+    expires_in = payload.get("exp", 0) - time.time()
+    if expires_in > 0:
+        auth_cache.set(token, user, ttl=min(AUTH_CACHE_TTL_SECONDS, expires_in))
     return user
 
 @app.get("/me", response_model=UserPublic)
@@ -148,7 +216,7 @@ async def read_current_user(current_user: dict = Depends(get_current_user)):
     return current_user
 
 @app.post('/rules')
-async def post_ruleset(data: dict):
+def post_ruleset(data: dict):
     userId = data.get("userId")
     model = data.get("model")
     profileName = data.get("profileName")
@@ -158,19 +226,19 @@ async def post_ruleset(data: dict):
     if not all([userId, model, ruleset]):
         raise HTTPException(status_code=400, detail="Missing basic userId, model, or ruleset in request body")
 
-    profileId = count_files_in_directory(str(UPLOAD_DIR))
-    filename = f"{userId}_{profileId}.json"
-    file_path = UPLOAD_DIR / filename
+    try:
+        profileId = ruleset_store.allocate_profile_id()
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
     try:
-        with open(file_path, "w") as f:
-            json.dump(ruleset, f, indent=4)
+        ruleset_store.save(userId, profileId, ruleset)
     except IOError as e:
         raise HTTPException(status_code=500, detail=f"Failed to save ruleset file: {e}")
 
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
 
         if not isinstance(profileName, str) or not profileName.strip():
@@ -185,12 +253,11 @@ async def post_ruleset(data: dict):
         )
         conn.commit()
     except sqlite3.Error as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        ruleset_store.delete(userId, profileId)
         raise HTTPException(status_code=500, detail=f"Database error: {e}. Ruleset file was not saved.")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
     chat_session_data = create_chat_session({"userId": userId, "profileId": profileId})
     chatlogId = chat_session_data["chatlogId"]
@@ -198,11 +265,11 @@ async def post_ruleset(data: dict):
     return {"profileId": profileId, "chatlogId": chatlogId}
 
 @app.delete('/rules/{profileId}')
-async def delete_ruleset(profileId: int, current_user: User = Depends(get_current_user)):
+def delete_ruleset(profileId: int, current_user: User = Depends(get_current_user)):
 
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM model_profiles WHERE profileId = ? AND userId = ?", (profileId, userId))
         conn.commit()
@@ -210,7 +277,7 @@ async def delete_ruleset(profileId: int, current_user: User = Depends(get_curren
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
 
 
@@ -219,9 +286,9 @@ def get_ruleset(userId: str, profileId: int, current_user: User = Depends(get_cu
 
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
-        cursor.execute("SELECT model FROM model_profiles WHERE userId = ? AND profileId = ?", (userId, profileId))
+        cursor.execute("SELECT model FROM model_profiles WHERE userId = ? AND profileId = ? AND deletedAt IS NULL", (userId, profileId))
         db_result = cursor.fetchone()
 
         if not db_result:
@@ -229,35 +296,29 @@ def get_ruleset(userId: str, profileId: int, current_user: User = Depends(get_cu
 
         model = db_result[0]
 
-        filename = f"{userId}_{profileId}.json"
-        file_path = UPLOAD_DIR / filename
-
-        if not file_path.is_file():
-            raise HTTPException(status_code=404, detail=f"Ruleset file not found for user {userId} with profileId {profileId}")
-
-        with open(file_path, "r") as f:
-            ruleset = json.load(f)
+        ruleset = ruleset_store.get(userId, profileId).ruleset
 
         return {"model": model, "ruleset": ruleset}
 
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Ruleset file not found for user {userId} with profileId {profileId}")
     except (IOError, json.JSONDecodeError) as e:
         raise HTTPException(status_code=500, detail=f"Error reading or parsing ruleset file: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
 @app.get('/profiles/{userId}')
 def get_user_profiles(userId: str, current_user: User = Depends(get_current_user)):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = db.connect()
         cursor = conn.cursor()
 
         cursor.execute(
-            "SELECT profileId, profileName FROM model_profiles WHERE userId = ?",
+            "SELECT profileId, profileName FROM model_profiles WHERE userId = ? AND deletedAt IS NULL",
             (userId,)
         )
 
@@ -268,43 +329,43 @@ def get_user_profiles(userId: str, current_user: User = Depends(get_current_user
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
-@app.delete('profiles/{userId}/{profileId}')
+@app.delete('/profiles/{userId}/{profileId}', status_code=202)
 def delete_user_profile(userId: str, profileId: int, current_user: User = Depends(get_current_user)):
+    if userId != current_user["username"]:
+        raise HTTPException(status_code=404, detail=f"Profile {profileId} not found")
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
 
-        # Find all chat logs associated with the profile
-        cursor.execute("SELECT chatlogId FROM chat_logs WHERE userId = ? AND profileId = ?", (userId, profileId))
-        chatlog_ids = [row[0] for row in cursor.fetchall()]
-
-        if chatlog_ids:
-            # Delete all messages from all associated chat logs
-            cursor.executemany("DELETE FROM messages WHERE chatlogId = ?", [(cid,) for cid in chatlog_ids])
-            # Delete all associated chat logs
-            cursor.execute("DELETE FROM chat_logs WHERE userId = ? AND profileId = ?", (userId, profileId))
+        # Hide the profile and its chats right away; the rows are purged in the background
+        cursor.execute(
+            "UPDATE model_profiles SET deletedAt = CURRENT_TIMESTAMP WHERE userId = ? AND profileId = ? AND deletedAt IS NULL",
+            (userId, profileId)
+        )
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail=f"Profile {profileId} not found")
+        cursor.execute(
+            "UPDATE chat_logs SET deletedAt = CURRENT_TIMESTAMP WHERE userId = ? AND profileId = ? AND deletedAt IS NULL",
+            (userId, profileId)
+        )
+        jobId = deletions.enqueue_profile(cursor, userId, profileId)
 
-        # Delete the model profile itself
-        cursor.execute("DELETE FROM model_profiles WHERE userId = ? AND profileId = ?", (userId, profileId))
-        
         conn.commit()
 
         # Delete the ruleset file
-        filename = f"{userId}_{profileId}.json"
-        file_path = UPLOAD_DIR / filename
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        ruleset_store.delete(userId, profileId)
+        deletions.wake()
 
-        return {"message": f"Profile {profileId} and all associated data deleted successfully."}
+        return {"message": f"Profile {profileId} deleted. Its data is being removed in the background.", "jobId": jobId}
 
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
 @app.post('/chats')
 def create_chat_session(data: dict):
@@ -316,7 +377,7 @@ def create_chat_session(data: dict):
 
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
 
         cursor.execute("INSERT INTO chat_logs (userId, profileId) VALUES (?, ?)", (userId, profileId))
@@ -329,19 +390,18 @@ def create_chat_session(data: dict):
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
 @app.get('/chats/{userId}/{profileId}')
-async def get_user_chats(userId: str, profileId: int, current_user: User = Depends(get_current_user)):
+def get_user_chats(userId: str, profileId: int, current_user: User = Depends(get_current_user)):
 
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = db.connect()
         cursor = conn.cursor()
 
         cursor.execute(
-            "SELECT chatlogId FROM chat_logs WHERE userId = ? AND profileId = ?",
+            "SELECT chatlogId FROM chat_logs WHERE userId = ? AND profileId = ? AND deletedAt IS NULL",
             (userId, profileId)
         )
 
@@ -352,47 +412,140 @@ async def get_user_chats(userId: str, profileId: int, current_user: User = Depen
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
-@app.delete('/chats/{chatlogId}')
+@app.delete('/chats/{chatlogId}', status_code=202)
 def delete_chat(chatlogId: int, current_user: User = Depends(get_current_user)):
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = db.connect()
         cursor = conn.cursor()
 
-        # Delete all messages for the chat log first
-        cursor.execute("DELETE FROM messages WHERE chatlogId = ?", (chatlogId,))
-        
-        # Then delete the chat log itself
-        cursor.execute("DELETE FROM chat_logs WHERE chatlogId = ?", (chatlogId,))
+        # Hide the chat log right away; its messages are purged in the background
+        cursor.execute(
+            "UPDATE chat_logs SET deletedAt = CURRENT_TIMESTAMP WHERE chatlogId = ? AND userId = ? AND deletedAt IS NULL",
+            (chatlogId, current_user["username"])
+        )
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail=f"Chat log with ID {chatlogId} not found")
+        jobId = deletions.enqueue_chat(cursor, current_user["username"], chatlogId)
 
         conn.commit()
-        return {"message": f"Chat log with ID {chatlogId} and its messages deleted successfully."}
+        deletions.wake()
+        return {"message": f"Chat log with ID {chatlogId} deleted. Its messages are being removed in the background.", "jobId": jobId}
 
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
+
+@app.get('/deletions/{jobId}')
+def get_deletion_progress(jobId: int, current_user: User = Depends(get_current_user)):
+    try:
+        job = deletions.get_job(jobId, current_user["username"])
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Deletion job {jobId} not found")
+    return job
+
+@app.get('/search')
+def search_messages(
+    q: str = Query(..., min_length=1, max_length=500),
+    profileId: Optional[int] = None,
+    limit: int = Query(search.SEARCH_PAGE_SIZE, ge=1, le=search.SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0, le=search.SEARCH_CANDIDATES),
+    before: Optional[int] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if offset and before is None:
+        raise HTTPException(status_code=400, detail="Pass the nextBefore of the previous page along with its nextOffset")
+    try:
+        with db.connection() as conn, metrics.span("search.query"):
+            results, next_page = search.search(conn.cursor(), current_user["username"], q, limit, offset, profileId, before)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    # Pass nextOffset and nextBefore back as offset and before for the next page
+    return {
+        "results": results,
+        "hasMore": next_page is not None,
+        "nextOffset": next_page["offset"] if next_page else None,
+        "nextBefore": next_page["before"] if next_page else None,
+    }
+
+@app.get('/export')
+def export_user_data(current_user: User = Depends(get_current_user)):
+    return StreamingResponse(
+        transfer.export_user(current_user["username"]),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="chat-export.ndjson"'}
+    )
+
+@app.post('/import')
+async def import_user_data(request: Request, current_user: User = Depends(get_current_user)):
+    try:
+        return await transfer.import_user(current_user["username"], request.stream())
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+MESSAGE_PAGE_SIZE = int(os.getenv("MESSAGE_PAGE_SIZE", "50"))
+MESSAGE_PAGE_MAX = 200
+
+def _message_page(cursor, chatlogId, last_messageId, archivedAt, before, after, limit):
+    """One page of a chat's messages, oldest first, and whether there are more."""
+    if archivedAt is not None:
+        with metrics.span("messages.archive"):
+            return archive.page(cursor, chatlogId, last_messageId, before, after, limit)
+
+    # Seek on the (chatlogId, messageId) primary key
+    with metrics.span("messages.page"):
+        if after is not None:
+            cursor.execute(
+                "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? AND messageId > ? ORDER BY messageId ASC LIMIT ?",
+                (chatlogId, after, limit + 1)
+            )
+            messages = cursor.fetchall()
+            return messages[:limit], len(messages) > limit
+
+        cursor.execute(
+            "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? AND messageId < ? ORDER BY messageId DESC LIMIT ?",
+            (chatlogId, before if before is not None else last_messageId + 1, limit + 1)
+        )
+        messages = cursor.fetchall()
+        return messages[:limit][::-1], len(messages) > limit
 
 @app.get('/chats/{userId}/{profileId}/{chatlogId}/messages')
-def get_chat_messages(userId: str, profileId: int, chatlogId: int, current_user: User = Depends(get_current_user)):
+def get_chat_messages(
+    userId: str,
+    profileId: int,
+    chatlogId: int,
+    request: Request,
+    response: Response,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MESSAGE_PAGE_MAX),
+    current_user: User = Depends(get_current_user)
+):
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+
     conn = None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+        conn = db.connect()
         cursor = conn.cursor()
 
         # 1. Verify ownership and get the model in one query
-        cursor.execute("""
-            SELECT mp.model
-            FROM chat_logs cl
-            JOIN model_profiles mp ON cl.userId = mp.userId AND cl.profileId = mp.profileId
-            WHERE cl.userId = ? AND cl.profileId = ? AND cl.chatlogId = ?
-        """, (userId, profileId, chatlogId))
-        
-        model_result = cursor.fetchone()
+        with metrics.span("messages.ownership"):
+            cursor.execute("""
+                SELECT mp.model, cl.lastMessageId, cl.archivedAt
+                FROM chat_logs cl
+                JOIN model_profiles mp ON cl.userId = mp.userId AND cl.profileId = mp.profileId
+                WHERE cl.userId = ? AND cl.profileId = ? AND cl.chatlogId = ? AND cl.deletedAt IS NULL
+            """, (userId, profileId, chatlogId))
+            model_result = cursor.fetchone()
+
         if model_result is None:
             raise HTTPException(
                 status_code=404,
@@ -401,111 +554,595 @@ def get_chat_messages(userId: str, profileId: int, chatlogId: int, current_user:
         
         model = model_result['model']
 
-        # 2. Fetch the messages
-        cursor.execute(
-            "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? ORDER BY messageId ASC",
-            (chatlogId,)
+        # 2. Messages are append-only, so the newest messageId identifies the chat's state
+        last_messageId = model_result['lastMessageId']
+        etag = f'W/"{chatlogId}-{last_messageId}"'
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+
+        # 3. Fetch one page; archived chats are paged from their decompressed blob
+        messages, has_more = _message_page(
+            cursor, chatlogId, last_messageId, model_result['archivedAt'], before, after, limit
         )
-        messages = cursor.fetchall()
-        
-        # 3. Return combined data
-        return {"model": model, "messages": [dict(row) for row in messages]}
+
+        # 4. Return combined data
+        return {
+            "model": model,
+            "messages": [dict(row) for row in messages],
+            "hasMore": has_more,
+            "lastMessageId": last_messageId,
+        }
 
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     finally:
         if conn:
-            conn.close()
+            db.release(conn)
 
-@app.post('/chats/response')
-async def get_chat_response(data: dict):
-    prompt = data.get("prompt")
-    chatlogId = data.get("chatlogId")
-    if not prompt:
-        raise HTTPException(status_code=400, detail="Missing prompt in request body")
-
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
+def load_workspace(userId, profileId, chatlogId, limit):
+    """Everything the app shows on load, from three queries however many profiles
+    and chats the user has: their profiles, each profile's chats, and the newest
+    page of the active chat (the one asked for, else the most recently active)."""
+    with db.connection() as conn:
         cursor = conn.cursor()
+        with metrics.span("workspace.profiles"):
+            profiles = {
+                row["profileId"]: {**dict(row), "chats": []}
+                for row in cursor.execute(
+                    "SELECT profileId, profileName, model FROM model_profiles WHERE userId = ? AND deletedAt IS NULL ORDER BY profileId",
+                    (userId,)
+                )
+            }
+        with metrics.span("workspace.chats"):
+            chats = [
+                row for row in cursor.execute("""
+                    SELECT chatlogId, profileId, lastActiveAt, lastMessageId, archivedAt FROM chat_logs
+                    WHERE userId = ? AND deletedAt IS NULL ORDER BY profileId, chatlogId
+                """, (userId,))
+                if row["profileId"] in profiles
+            ]
+        for chat in chats:
+            profiles[chat["profileId"]]["chats"].append({"chatlogId": chat["chatlogId"], "lastActiveAt": chat["lastActiveAt"]})
+
+        # A stale chat or profile id (e.g. deleted on another device) falls back rather than failing
+        active = next((chat for chat in chats if chat["chatlogId"] == chatlogId), None)
+        if active is None:
+            candidates = [chat for chat in chats if profileId not in profiles or chat["profileId"] == profileId]
+            active = max(candidates, key=lambda chat: (chat["lastActiveAt"] or "", chat["chatlogId"]), default=None)
+
+        active_chat = None
+        if active is not None:
+            messages, has_more = _message_page(
+                cursor, active["chatlogId"], active["lastMessageId"], active["archivedAt"], None, None, limit
+            )
+            active_chat = {
+                "chatlogId": active["chatlogId"],
+                "profileId": active["profileId"],
+                "model": profiles[active["profileId"]]["model"],
+                "messages": [dict(row) for row in messages],
+                "hasMore": has_more,
+                "lastMessageId": active["lastMessageId"],
+            }
+
+    if active is not None:
+        active_profileId = active["profileId"]
+    elif profileId in profiles:
+        active_profileId = profileId
+    else:
+        active_profileId = next(iter(profiles), None)
+    return {"profiles": list(profiles.values()), "activeProfileId": active_profileId, "activeChat": active_chat}
+
+@app.get('/workspace', response_class=FastJSONResponse)
+async def get_workspace(
+    profileId: Optional[int] = None,
+    chatlogId: Optional[int] = None,
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MESSAGE_PAGE_MAX),
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        with metrics.span("workspace.load"):
+            workspace = await db.run(load_workspace, current_user["username"], profileId, chatlogId, limit)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    # Returned as a response so FastAPI doesn't walk the payload through jsonable_encoder first
+    return FastJSONResponse(workspace, headers={"Cache-Control": "private, no-cache"})
+
+def load_chat_session(chatlogId, userId):
+    with db.connection() as conn:
+        return _load_chat_session(conn.cursor(), chatlogId, userId)
 
+def _load_chat_session(cursor, chatlogId, userId):
+    with metrics.span("chat.lookup"):
         cursor.execute("""
-            SELECT cl.userId, cl.profileId, mp.model 
+            SELECT cl.userId, cl.profileId, cl.archivedAt, mp.model
             FROM chat_logs cl JOIN model_profiles mp ON cl.userId = mp.userId AND cl.profileId = mp.profileId
-            WHERE cl.chatlogId = ?
-        """, (chatlogId,))
+            WHERE cl.chatlogId = ? AND cl.userId = ? AND cl.deletedAt IS NULL
+        """, (chatlogId, userId))
         chat_data = cursor.fetchone()
-        if not chat_data:
-            raise HTTPException(status_code=404, detail=f"Chat log with ID {chatlogId} not found")
+    if not chat_data:
+        raise HTTPException(status_code=404, detail=f"Chat log with ID {chatlogId} not found")
 
-        userId, profileId, model_name = chat_data["userId"], chat_data["profileId"], chat_data["model"]
+    # A new turn brings an archived chat back into the messages table
+    if chat_data["archivedAt"] is not None:
+        with metrics.span("archive.rehydrate"):
+            archive.rehydrate(cursor, chatlogId)
+            cursor.connection.commit()
 
-        filename = f"{userId}_{profileId}.json"
-        file_path = UPLOAD_DIR / filename
-        if not file_path.is_file():
-            raise HTTPException(status_code=404, detail=f"Ruleset file not found: {filename}")
-        with open(file_path, "r") as f:
-            ruleset = json.load(f)
-        
-        system_prompt = f"You must strictly follow these rules: {json.dumps(ruleset)}"
+    userId, profileId, model_name = chat_data["userId"], chat_data["profileId"], chat_data["model"]
 
-        cursor.execute("SELECT sender, messageContent FROM messages WHERE chatlogId = ? ORDER BY messageId ASC", (chatlogId,))
-        history = cursor.fetchall()
+    try:
+        with metrics.span("ruleset.load"):
+            cached = ruleset_store.get(userId, profileId)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Ruleset file not found: {userId}_{profileId}.json")
+
+    with metrics.span("history.query"):
+        chat_context = context.load_context(cursor, chatlogId)
+    return _start_chat(cached, chat_context)
+
+def _start_chat(cached, chat_context):
+    history = chat_context.history_for_model()
+    metrics.CHAT_HISTORY_MESSAGES.observe(len(history))
+    chat_session = cached.model.start_chat(history=history)
+    return chat_session, chat_context, (cached.system_prompt, history)
+
+def save_chat_turn(chatlogId, prompt, response_content):
+    with db.connection() as conn:
+        _save_chat_turn(conn.cursor(), chatlogId, prompt, response_content)
+        conn.commit()
 
-        llm = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            system_instruction=system_prompt,
-            generation_config={"temperature": 0.2}
-        )
+def _save_chat_turn(cursor, chatlogId, prompt, response_content):
+    # Reserve two ids on the chat's counter; the UPDATE also takes the write lock
+    # so concurrent turns in the same chat cannot collide.
+    cursor.execute(
+        """
+        UPDATE chat_logs SET lastMessageId = lastMessageId + 2, lastActiveAt = CURRENT_TIMESTAMP
+        WHERE chatlogId = ? AND deletedAt IS NULL RETURNING lastMessageId, archivedAt
+        """,
+        (chatlogId,)
+    )
+    row = cursor.fetchone()
+    # The chat may have been deleted while the LLM was answering
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Chat log with ID {chatlogId} not found")
+    llm_messageId, archivedAt = row
+    user_messageId = llm_messageId - 1
+
+    # The archiver may have taken the chat while the LLM was answering
+    if archivedAt is not None:
+        archive.rehydrate(cursor, chatlogId)
+
+    cursor.execute(
+        "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+        (chatlogId, user_messageId, 'user', prompt)
+    )
+    cursor.execute(
+        "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+        (chatlogId, llm_messageId, 'llm', response_content)
+    )
+
+def blocked_response_detail(llm_response, e):
+    # This can happen if the response is blocked due to safety settings or other reasons.
+    finish_reason = "Unknown"
+    if llm_response.candidates and llm_response.candidates[0].finish_reason:
+        finish_reason = llm_response.candidates[0].finish_reason.name
+    return f"API response was blocked or empty. Finish Reason: {finish_reason}. Error: {e}"
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def finish_streamed_turn(chat_context, chatlogId, prompt, response_content, cache_key=None):
+    metrics.CHAT_RESPONSE_CHARS.observe(len(response_content))
+    try:
+        with metrics.span("chat.save_turn"):
+            await db.run(save_chat_turn, chatlogId, prompt, response_content)
+    except HTTPException as e:
+        yield sse_event("error", {"detail": e.detail})
+        return
+    except sqlite3.Error as e:
+        yield sse_event("error", {"detail": f"Database error: {e}"})
+        return
+    # Only answers that were saved to their chat are cached
+    if cache_key is not None:
+        await response_cache.cache.store(cache_key, response_content)
+    if chat_context.needs_summary:
+        context.schedule_summary(chatlogId)
+
+    yield sse_event("done", {"response": response_content})
+
+async def stream_cached_response(chat_context, chatlogId, prompt, response_content):
+    yield sse_event("token", {"token": response_content})
+    async for event in finish_streamed_turn(chat_context, chatlogId, prompt, response_content):
+        yield event
+
+async def stream_chat_response(request: Request, chat_session, chat_context, chatlogId, prompt, cache_key, release_slot, caller):
+    # Starlette cancels this generator when the client disconnects, which raises
+    # CancelledError inside the pending upstream read and aborts the Gemini stream.
+    chunks = []
+    try:
+        async for chunk in llm.stream_message(chat_session, prompt):
+            if await request.is_disconnected():
+                return
+            try:
+                text = chunk.text
+            except ValueError as e:
+                yield sse_event("error", {"detail": blocked_response_detail(chunk, e)})
+                return
+            chunks.append(text)
+            yield sse_event("token", {"token": text})
+    except HTTPException as e:
+        yield sse_event("error", {"detail": e.detail})
+        return
+    except Exception as e:
+        yield sse_event("error", {"detail": f"Failed to get response from LLM: {e}"})
+        return
+    finally:
+        release_slot()
+        # A stream that ended before its usage was reported is not charged the estimate
+        admission.refund(caller)
 
-        chat_history_for_model = []
-        for message in history:
-            role = "model" if message["sender"] == "llm" else "user"
-            chat_history_for_model.append({"role": role, "parts": [message["messageContent"]]})
-        
-        chat_session = llm.start_chat(history=chat_history_for_model)
+    response_content = "".join(chunks)
+    async for event in finish_streamed_turn(chat_context, chatlogId, prompt, response_content, cache_key):
+        yield event
 
+async def ask_llm(chat_session, prompt):
+    try:
+        llm_response = await llm.send_message(chat_session, prompt)
         try:
-            llm_response = chat_session.send_message(prompt)
-            try:
-                response_content = llm_response.text
-            except ValueError as e:
-                # This can happen if the response is blocked due to safety settings or other reasons.
-                finish_reason = "Unknown"
-                if llm_response.candidates and llm_response.candidates[0].finish_reason:
-                    finish_reason = llm_response.candidates[0].finish_reason.name
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"API response was blocked or empty. Finish Reason: {finish_reason}. Error: {e}"
-                )
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Failed to get response from LLM: {e}")
+            return llm_response.text
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=blocked_response_detail(llm_response, e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get response from LLM: {e}")
+
+async def complete_chat_turn(chat_session, chat_context, chatlogId, prompt, cache_key, coalesce=True):
+    if coalesce:
+        # Identical requests share one upstream call and later ones are served from the cache.
+        response_content = await response_cache.cache.get_or_compute(cache_key, lambda: ask_llm(chat_session, prompt))
+    else:
+        # The shared call outlives its callers; called directly, cancelling the caller cancels it.
+        response_content = await response_cache.cache.lookup(cache_key)
+        if response_content is None:
+            response_content = await ask_llm(chat_session, prompt)
+            await response_cache.cache.store(cache_key, response_content)
+    metrics.CHAT_RESPONSE_CHARS.observe(len(response_content))
 
-        cursor.execute("SELECT MAX(messageId) FROM messages WHERE chatlogId = ?", (chatlogId,))
-        max_id = cursor.fetchone()[0]
-        user_messageId = (max_id + 1) if max_id is not None else 0
-        llm_messageId = user_messageId + 1
+    try:
+        with metrics.span("chat.save_turn"):
+            await db.run(save_chat_turn, chatlogId, prompt, response_content)
+    except HTTPException:
+        await response_cache.cache.discard(cache_key)
+        raise
+    if chat_context.needs_summary:
+        context.schedule_summary(chatlogId)
+    return response_content
 
-        cursor.execute(
-            "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
-            (chatlogId, user_messageId, 'user', prompt)
-        )
-        cursor.execute(
-            "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
-            (chatlogId, llm_messageId, 'llm', response_content)
-        )
+@app.post('/chats/response')
+async def get_chat_response(
+    request: Request,
+    data: dict,
+    stream: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    prompt = data.get("prompt")
+    chatlogId = data.get("chatlogId")
+    if not prompt:
+        raise HTTPException(status_code=400, detail="Missing prompt in request body")
+    metrics.CHAT_PROMPT_CHARS.observe(len(prompt))
 
-        conn.commit()
+    try:
+        with metrics.span("chat.load_session"):
+            chat_session, chat_context, (system_prompt, history) = await db.run(
+                load_chat_session, chatlogId, current_user["username"]
+            )
+        # Charged once the chat is known to be the caller's. History tokens aren't
+        # known yet; they are charged once the LLM reports its usage.
+        caller = admission.admit(current_user, tokens=context.estimate_tokens(prompt))
+        cache_key = response_cache.make_key(system_prompt, history, prompt)
+
+        if stream:
+            cached_response = await response_cache.cache.lookup(cache_key)
+            if cached_response is not None:
+                admission.refund(caller)
+                return StreamingResponse(
+                    stream_cached_response(chat_context, chatlogId, prompt, cached_response),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+                )
 
+            # The slot is held for the life of the stream; the background task
+            # frees it even if the body is never iterated. Messages are written
+            # once the stream finishes.
+            try:
+                release_slot = await llm.limiter.acquire()
+            except BaseException:
+                admission.refund(caller)
+                raise
+            return StreamingResponse(
+                stream_chat_response(request, chat_session, chat_context, chatlogId, prompt, cache_key, release_slot, caller),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                background=BackgroundTask(release_slot)
+            )
+
+        try:
+            response_content = await complete_chat_turn(chat_session, chat_context, chatlogId, prompt, cache_key)
+        finally:
+            # Cache hits, coalesced waits and failures made no LLM call of their own
+            admission.refund(caller)
         return {"response": response_content}
 
+    except HTTPException:
+        raise
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     except (IOError, json.JSONDecodeError) as e:
         raise HTTPException(status_code=500, detail=f"Error reading or parsing ruleset file: {e}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+
+def save_job_turn(job, response_content):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        if not jobs.mark_done(cursor, job, response_content):
+            conn.rollback()
+            return False
+        _save_chat_turn(cursor, job["chatlogId"], job["prompt"], response_content)
+        conn.commit()
+    return True
+
+async def run_chat_job(job):
+    # The job was charged to the user's buckets when it was submitted; only the
+    # first attempt's estimate is settled against real usage.
+    user = await db.run(find_user_by_username, job["userId"])
+    if user is None:
+        raise HTTPException(status_code=404, detail=f"Chat log with ID {job['chatlogId']} not found")
+    estimate = context.estimate_tokens(job["prompt"]) if job["attempts"] == 1 else 0
+    caller = admission.bind(job["userId"], admission.tier_of(dict(user)), estimate)
+
+    # The answer and the chat turn are committed together, so a retried job never adds the turn twice
+    try:
+        chat_session, chat_context, (system_prompt, history) = await db.run(load_chat_session, job["chatlogId"], job["userId"])
+        cache_key = response_cache.make_key(system_prompt, history, job["prompt"])
+        response_content = await response_cache.cache.get_or_compute(cache_key, lambda: ask_llm(chat_session, job["prompt"]))
     finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        admission.refund(caller)
+    metrics.CHAT_RESPONSE_CHARS.observe(len(response_content))
+
+    try:
+        with metrics.span("chat.save_turn"):
+            saved = await db.run(save_job_turn, job, response_content)
+    except HTTPException:
+        await response_cache.cache.discard(cache_key)
+        raise
+    if saved and chat_context.needs_summary:
+        context.schedule_summary(job["chatlogId"])
+
+@app.post('/chats/response/jobs', status_code=202)
+def submit_chat_job(
+    data: dict,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None, max_length=200),
+    current_user: User = Depends(get_current_user)
+):
+    prompt = data.get("prompt")
+    chatlogId = data.get("chatlogId")
+    if not prompt or not isinstance(chatlogId, int):
+        raise HTTPException(status_code=400, detail="Missing prompt or chatlogId in request body")
+    metrics.CHAT_PROMPT_CHARS.observe(len(prompt))
+
+    try:
+        if idempotency_key is None or jobs.get_by_key(current_user["username"], idempotency_key) is None:
+            admission.admit(current_user, tokens=context.estimate_tokens(prompt))
+        job, created = jobs.submit(current_user["username"], chatlogId, prompt, idempotency_key)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    # A repeated idempotency key returns the original job
+    if not created:
+        response.status_code = 200
+    response.headers["Location"] = f"/jobs/{job['jobId']}"
+    return jobs.public(job)
+
+@app.get('/jobs/{jobId}')
+async def get_chat_job(
+    jobId: int,
+    wait: float = Query(0, ge=0, le=jobs.LLM_JOB_WAIT_MAX_SECONDS),
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        job = await jobs.wait(jobId, current_user["username"], wait)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {jobId} not found")
+    return jobs.public(job)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "5"))
+
+def load_batch_sessions(userId, chatlogIds, profileIds):
+    """Open a chat session for each requested chat, or for a new chat on each
+    requested profile, using one connection and a fixed number of queries.
+    Returns (item, session) pairs; session is an HTTPException for items that failed."""
+    with db.connection() as conn:
+        cursor = conn.cursor()
+
+        if profileIds is not None:
+            placeholders = ",".join("?" * len(profileIds))
+            owned = {row["profileId"] for row in cursor.execute(
+                f"SELECT profileId FROM model_profiles WHERE userId = ? AND deletedAt IS NULL AND profileId IN ({placeholders})",
+                (userId, *profileIds)
+            )}
+            items = []
+            for profileId in profileIds:
+                chatlogId = None
+                if profileId in owned:
+                    cursor.execute("INSERT INTO chat_logs (userId, profileId) VALUES (?, ?)", (userId, profileId))
+                    chatlogId = cursor.lastrowid
+                items.append({"profileId": profileId, "chatlogId": chatlogId})
+            conn.commit()
+        else:
+            items = [{"chatlogId": chatlogId} for chatlogId in chatlogIds]
+
+        ids = [item["chatlogId"] for item in items if item["chatlogId"] is not None]
+        placeholders = ",".join("?" * len(ids))
+        with metrics.span("chat.lookup"):
+            rows = cursor.execute(f"""
+                SELECT cl.chatlogId, cl.profileId, cl.summary, cl.summarizedThroughId, cl.archivedAt
+                FROM chat_logs cl JOIN model_profiles mp ON cl.userId = mp.userId AND cl.profileId = mp.profileId
+                WHERE cl.userId = ? AND cl.deletedAt IS NULL AND mp.deletedAt IS NULL AND cl.chatlogId IN ({placeholders})
+            """, (userId, *ids)).fetchall() if ids else []
+        archived = [row["chatlogId"] for row in rows if row["archivedAt"] is not None]
+        if archived:
+            with metrics.span("archive.rehydrate"):
+                for chatlogId in archived:
+                    archive.rehydrate(cursor, chatlogId)
+                conn.commit()
+        with metrics.span("history.query"):
+            contexts = context.load_contexts(cursor, rows)
+
+    chats = {row["chatlogId"]: row for row in rows}
+    loaded = []
+    for item in items:
+        row = chats.get(item["chatlogId"])
+        if row is None:
+            if item["chatlogId"] is None:
+                loaded.append((item, HTTPException(status_code=404, detail=f"Profile {item['profileId']} not found")))
+            else:
+                loaded.append((item, HTTPException(status_code=404, detail=f"Chat log with ID {item['chatlogId']} not found")))
+            continue
+
+        item["profileId"] = row["profileId"]
+        try:
+            with metrics.span("ruleset.load"):
+                cached = ruleset_store.get(userId, row["profileId"])
+        except FileNotFoundError:
+            loaded.append((item, HTTPException(status_code=404, detail=f"Ruleset file not found: {userId}_{row['profileId']}.json")))
+            continue
+        except (IOError, json.JSONDecodeError) as e:
+            loaded.append((item, HTTPException(status_code=500, detail=f"Error reading or parsing ruleset file: {e}")))
+            continue
+        loaded.append((item, _start_chat(cached, contexts[row["chatlogId"]])))
+    return loaded
+
+def discard_new_chat(chatlogId):
+    # Only while no turn has been saved to it
+    with db.connection() as conn:
+        conn.execute("DELETE FROM chat_logs WHERE chatlogId = ? AND lastMessageId < 0", (chatlogId,))
+        conn.commit()
+
+async def run_batch_item(semaphore, item, session, prompt, new_chat):
+    result = dict(item)
+    try:
+        if isinstance(session, HTTPException):
+            result["error"] = {"status": session.status_code, "detail": session.detail}
+            return result
+
+        chat_session, chat_context, (system_prompt, history) = session
+        cache_key = response_cache.make_key(system_prompt, history, prompt)
+        try:
+            async with semaphore:
+                result["response"] = await complete_chat_turn(
+                    chat_session, chat_context, item["chatlogId"], prompt, cache_key, coalesce=False
+                )
+        except HTTPException as e:
+            result["error"] = {"status": e.status_code, "detail": e.detail}
+        except sqlite3.Error as e:
+            result["error"] = {"status": 500, "detail": f"Database error: {e}"}
+        except Exception as e:
+            result["error"] = {"status": 500, "detail": f"An unexpected error occurred: {e}"}
+        return result
+    finally:
+        # A chat created for this item is kept only if the item's turn was saved
+        if new_chat and item["chatlogId"] is not None and "response" not in result:
+            result["chatlogId"] = None
+            try:
+                await db.run(discard_new_chat, item["chatlogId"])
+            except sqlite3.Error:
+                logger.exception("Could not remove unused batch chat %s", item["chatlogId"])
+
+async def stream_batch_results(loaded, prompt, new_chats, caller):
+    # One JSON object per line, in the order the items finish.
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    tasks = [
+        asyncio.create_task(run_batch_item(semaphore, item, session, prompt, new_chats))
+        for item, session in loaded
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield json.dumps(await finished) + "\n"
+    finally:
+        # The client went away; stop the items that have not finished, which
+        # cancels their upstream calls.
+        for task in tasks:
+            task.cancel()
+        # Items answered from the cache or failed left part of the estimate unsettled
+        admission.refund(caller)
+
+@app.post('/chats/response/batch')
+async def get_batch_chat_response(data: dict, current_user: User = Depends(get_current_user)):
+    prompt = data.get("prompt")
+    chatlogIds = data.get("chatlogIds")
+    profileIds = data.get("profileIds")
+    if not prompt:
+        raise HTTPException(status_code=400, detail="Missing prompt in request body")
+    if (chatlogIds is None) == (profileIds is None):
+        raise HTTPException(status_code=400, detail="Provide either chatlogIds or profileIds")
+
+    ids = chatlogIds if chatlogIds is not None else profileIds
+    if not isinstance(ids, list) or not ids or not all(isinstance(i, int) for i in ids):
+        raise HTTPException(status_code=400, detail="chatlogIds or profileIds must be a non-empty list of integers")
+    if len(ids) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+    if len(set(ids)) != len(ids):
+        raise HTTPException(status_code=400, detail="Duplicate ids in batch")
+    metrics.CHAT_PROMPT_CHARS.observe(len(prompt))
+
+    try:
+        with metrics.span("batch.load_sessions"):
+            loaded = await db.run(load_batch_sessions, current_user["username"], chatlogIds, profileIds)
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    # Only items whose chat loaded are charged
+    runnable = sum(1 for _, session in loaded if not isinstance(session, HTTPException))
+    try:
+        caller = admission.admit(current_user, tokens=context.estimate_tokens(prompt) * runnable, requests=runnable)
+    except HTTPException:
+        if profileIds is not None:
+            for item, _ in loaded:
+                if item["chatlogId"] is not None:
+                    await db.run(discard_new_chat, item["chatlogId"])
+        raise
+
+    return StreamingResponse(
+        stream_batch_results(loaded, prompt, profileIds is not None, caller),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get('/llm/queue')
+def get_llm_queue(current_user: User = Depends(get_current_user)):
+    if admission.tier_of(current_user) != "admin":
+        raise HTTPException(status_code=403, detail="Admins only")
+    return llm.queue_stats()
+
+@app.get('/llm/cache/stats')
+def get_llm_cache_stats(current_user: User = Depends(get_current_user)):
+    return response_cache.cache.stats()
+
+@app.get('/archive/stats')
+def get_archive_stats(current_user: User = Depends(get_current_user)):
+    try:
+        return archive.stats()
+    except sqlite3.Error as e:
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+@app.get('/metrics')
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
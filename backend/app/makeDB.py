@@ -1,65 +1,37 @@
 import sqlite3
+import sys
 
-def create_database():
+import db
+import migrations
 
-
-
-    """Creates and initializes the SQLite database. This version allows NULL for profileName for diagnostic purposes."""
+def create_database(reset=False):
+    """Creates the SQLite database, or upgrades an existing one in place by applying any pending migrations."""
     conn = None
     try:
-        conn = sqlite3.connect('database.db')
-        cursor = conn.cursor()
-
-        # Drop existing tables for a clean migration. NOTE: This is a destructive action.
-        print("Dropping old tables for schema migration...")
-        cursor.execute("DROP TABLE IF EXISTS messages")
-        cursor.execute("DROP TABLE IF EXISTS chat_logs")
-        cursor.execute("DROP TABLE IF EXISTS model_profiles")
-        cursor.execute("DROP TABLE IF EXISTS users")
-
-        # --- Create Tables with Correct Schema ---
-        print("Creating new tables with diagnostic schema...")
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT NOT NULL UNIQUE PRIMARY KEY,
-                email TEXT NOT NULL UNIQUE,
-                hashed_pass TEXT NOT NULL
-            )
-        ''')
-
-        # --- DIAGNOSTIC CHANGE: profileName is now allowed to be NULL ---
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS model_profiles (
-                userId TEXT NOT NULL,
-                profileId INTEGER NOT NULL,
-                profileName TEXT NOT NULL, -- Temporarily allowing NULL to diagnose the issue
-                model TEXT NOT NULL,
-                UNIQUE (userId, profileId)
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_logs (
-                chatlogId INTEGER PRIMARY KEY AUTOINCREMENT,
-                userId TEXT NOT NULL,
-                profileId INTEGER NOT NULL,
-                FOREIGN KEY (userId, profileId) REFERENCES model_profiles (userId, profileId)
-            )
-        ''')
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                chatlogId INTEGER NOT NULL,
-                messageId INTEGER NOT NULL,
-                sender TEXT NOT NULL CHECK(sender IN ('user', 'llm')),
-                messageContent TEXT NOT NULL,
-                PRIMARY KEY (chatlogId, messageId),
-                FOREIGN KEY (chatlogId) REFERENCES chat_logs (chatlogId)
-            )
-        ''')
-
-        conn.commit()
-        print("Database schema has been updated for diagnostics.")
+        if reset:
+            conn = sqlite3.connect(db.DB_PATH)
+            cursor = conn.cursor()
+
+            # Drop existing tables for a clean start. NOTE: This is a destructive action.
+            print("Dropping old tables...")
+            # Every table the migrations created goes, so no job, archive or index row
+            # outlives the chat ids it refers to. Virtual tables first: dropping one
+            # also drops its shadow tables, and triggers go with their tables.
+            tables = cursor.execute("""
+                SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'
+                ORDER BY sql LIKE 'CREATE VIRTUAL TABLE%' DESC
+            """).fetchall()
+            for (name,) in tables:
+                cursor.execute(f'DROP TABLE IF EXISTS "{name}"')
+            cursor.execute("PRAGMA user_version = 0")
+            conn.commit()
+
+        print("Applying schema migrations...")
+        applied = migrations.migrate(verbose=True)
+        if applied:
+            print(f"Database schema is now at version {applied[-1]}.")
+        else:
+            print("Database schema is already up to date.")
 
     except sqlite3.Error as e:
         print(f"Database error: {e}")
@@ -69,4 +41,4 @@ def create_database():
             print("Database connection closed.")
 
 if __name__ == "__main__":
-    create_database()
\ No newline at end of file
+    create_database(reset="--reset" in sys.argv)
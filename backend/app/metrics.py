@@ -0,0 +1,239 @@
+import bisect
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+# In-process metrics in the Prometheus text format, served from /metrics.
+# Recording a value is a lock and a bisect, so it is cheap enough to leave on.
+# Spans time the stages of a request; they feed a histogram per stage and,
+# when SLOW_REQUEST_SECONDS is set, a log line breaking down slow requests.
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+logger = logging.getLogger(__name__)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labelvalues, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [("", key, None, value) for key, value in items]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        samples = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", key, ("le", _format_value(float(bound))), cumulative))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, count))
+        return samples
+
+
+class Gauge(_Metric):
+    """A value read when /metrics is scraped. callback returns a number, or a
+    dict mapping label-value tuples to numbers. Pass kind="counter" to expose
+    a running total kept elsewhere."""
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, callback, labelnames=(), kind="gauge"):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.type = kind
+
+    def _samples(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            return [("", key, None, v) for key, v in value.items()]
+        return [("", (), None, value)]
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception("Failed to render metric %s", metric.name)
+    return "\n".join(lines) + "\n"
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to serve an HTTP request.", ["method", "route"])
+REQUESTS = Counter("http_requests_total", "HTTP requests served.", ["method", "route", "status"])
+STAGE_SECONDS = Histogram("app_stage_duration_seconds", "Time spent in each stage of a request.", ["stage"])
+STAGE_ERRORS = Counter("app_stage_errors_total", "Stages that ended with an exception.", ["stage"])
+CHAT_HISTORY_MESSAGES = Histogram("chat_history_messages", "Messages sent to the LLM as chat history.", buckets=COUNT_BUCKETS)
+CHAT_PROMPT_CHARS = Histogram("chat_prompt_chars", "Length of chat prompts in characters.", buckets=SIZE_BUCKETS)
+CHAT_RESPONSE_CHARS = Histogram("chat_response_chars", "Length of LLM responses in characters.", buckets=SIZE_BUCKETS)
+LLM_TOKENS = Histogram("llm_tokens", "Tokens used per upstream LLM call.", ["kind"], buckets=(16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576))
+
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+class span:
+    """Time a block as a named stage: `with metrics.span("ruleset.load"): ...`"""
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        STAGE_SECONDS.observe(elapsed, stage=self.stage)
+        # HTTPExceptions such as 404s are outcomes, not failures of the stage.
+        if exc_type is not None and getattr(exc, "status_code", 500) >= 500:
+            STAGE_ERRORS.inc(stage=self.stage)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages.append((self.stage, elapsed))
+        return False
+
+
+def record_usage(response):
+    """Record token counts from a Gemini response's usage_metadata, if it has any."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0)
+    response_tokens = getattr(usage, "candidates_token_count", 0)
+    if prompt_tokens:
+        LLM_TOKENS.observe(prompt_tokens, kind="prompt")
+    if response_tokens:
+        LLM_TOKENS.observe(response_tokens, kind="response")
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware; unlike BaseHTTPMiddleware it adds no extra task per request."""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route_path(self, scope):
+        if self._routes is None:
+            self._routes = {getattr(r, "endpoint", None): r.path for r in scope["app"].routes if hasattr(r, "path")}
+        return self._routes.get(scope.get("endpoint"), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stages = []
+        token = _request_stages.set(stages)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_stages.reset(token)
+            route = self._route_path(scope)
+            REQUEST_SECONDS.observe(elapsed, method=scope["method"], route=route)
+            REQUESTS.inc(method=scope["method"], route=route, status=status)
+            if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+                logger.warning("Slow request %s", json.dumps({
+                    "method": scope["method"],
+                    "route": route,
+                    "status": status,
+                    "seconds": round(elapsed, 4),
+                    "stages": [[stage, round(seconds, 4)] for stage, seconds in stages],
+                }))
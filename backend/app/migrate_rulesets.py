@@ -0,0 +1,70 @@
+import os
+import sqlite3
+from pathlib import Path
+
+import db
+import ruleset_store
+
+
+def move_flat_files(ruleset_dir=None):
+    """Move flat rulesets/{userId}_{profileId}.json files in `ruleset_dir` (the
+    app's RULESET_DIR by default) into the sharded layout.
+    Returns (files moved, highest profileId seen in any ruleset file, or -1)."""
+    ruleset_dir = Path(ruleset_dir or ruleset_store.UPLOAD_DIR)
+    moved = 0
+    highest_id = -1
+    if not ruleset_dir.is_dir():
+        return moved, highest_id
+
+    for entry in os.scandir(ruleset_dir):
+        if not entry.is_file() or not entry.name.endswith(".json"):
+            continue
+        userId, _, profile_part = entry.name[:-len(".json")].rpartition("_")
+        if not userId or not profile_part.isdigit():
+            print(f"Skipping unrecognised file: {entry.name}")
+            continue
+
+        profileId = int(profile_part)
+        target = ruleset_store.ruleset_path(userId, profileId, ruleset_dir)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(entry.path, target)
+        highest_id = max(highest_id, profileId)
+        moved += 1
+
+    # Files that were already sharded still count towards the next id.
+    for shard in os.scandir(ruleset_dir):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            profile_part = entry.name[:-len(".json")].rpartition("_")[2]
+            if entry.name.endswith(".json") and profile_part.isdigit():
+                highest_id = max(highest_id, int(profile_part))
+    return moved, highest_id
+
+
+def seed_profile_counter(conn, highest_id: int) -> int:
+    """Move the profileId counter past every id in use; it never goes backwards. Returns the next id."""
+    db_highest = conn.execute("SELECT MAX(profileId) FROM model_profiles").fetchone()[0]
+    if db_highest is not None:
+        highest_id = max(highest_id, db_highest)
+    conn.execute("""
+        INSERT INTO counters (name, value) VALUES ('profileId', ?)
+        ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+    """, (highest_id + 1,))
+    return conn.execute("SELECT value FROM counters WHERE name = 'profileId'").fetchone()[0]
+
+
+def migrate_rulesets():
+    """Run by migration 10 on upgrade; run it again by hand after copying in flat ruleset files."""
+    moved, highest_id = move_flat_files()
+    with db.connection() as conn:
+        next_id = seed_profile_counter(conn, highest_id)
+        conn.commit()
+    print(f"Moved {moved} ruleset files. Next profileId is {next_id}.")
+
+
+if __name__ == "__main__":
+    try:
+        migrate_rulesets()
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
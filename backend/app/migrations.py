@@ -0,0 +1,378 @@
+import sqlite3
+import sys
+from pathlib import Path
+
+import db
+
+# Versioned, non-destructive schema upgrades. The database's PRAGMA user_version
+# records the last migration applied; each migration runs in its own
+# transaction together with the version bump, so a failed step leaves the
+# database at the previous version. Append new migrations to the end of
+# MIGRATIONS and never edit one that has shipped.
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_missing_columns(conn, table, columns):
+    existing = _columns(conn, table)
+    for name, definition in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _baseline(conn):
+    """The schema makeDB.py used to create, plus columns older databases may lack."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT NOT NULL UNIQUE PRIMARY KEY,
+            email TEXT NOT NULL UNIQUE,
+            hashed_pass TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS model_profiles (
+            userId TEXT NOT NULL,
+            profileId INTEGER NOT NULL,
+            profileName TEXT NOT NULL,
+            model TEXT NOT NULL,
+            UNIQUE (userId, profileId)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_logs (
+            chatlogId INTEGER PRIMARY KEY AUTOINCREMENT,
+            userId TEXT NOT NULL,
+            profileId INTEGER NOT NULL,
+            summary TEXT,
+            summarizedThroughId INTEGER,
+            FOREIGN KEY (userId, profileId) REFERENCES model_profiles (userId, profileId)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            chatlogId INTEGER NOT NULL,
+            messageId INTEGER NOT NULL,
+            sender TEXT NOT NULL CHECK(sender IN ('user', 'llm')),
+            messageContent TEXT NOT NULL,
+            PRIMARY KEY (chatlogId, messageId),
+            FOREIGN KEY (chatlogId) REFERENCES chat_logs (chatlogId)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    _add_missing_columns(conn, "model_profiles", [("profileName", "TEXT NOT NULL DEFAULT ''")])
+    _add_missing_columns(conn, "chat_logs", [("summary", "TEXT"), ("summarizedThroughId", "INTEGER")])
+
+
+def _index_chat_logs_by_profile(conn):
+    # get_user_chats and delete_user_profile filter chat_logs on (userId, profileId).
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_logs_user_profile ON chat_logs (userId, profileId)")
+
+
+def _add_last_message_id(conn):
+    # Replaces the per-turn SELECT MAX(messageId); -1 means the chat has no messages yet.
+    _add_missing_columns(conn, "chat_logs", [("lastMessageId", "INTEGER NOT NULL DEFAULT -1")])
+    conn.execute('''
+        UPDATE chat_logs SET lastMessageId = IFNULL(
+            (SELECT MAX(messageId) FROM messages WHERE messages.chatlogId = chat_logs.chatlogId), -1
+        )
+    ''')
+
+
+def _cascade_deletes(conn):
+    # SQLite cannot alter a foreign key, so both child tables are rebuilt.
+    # Runs with foreign_keys off (see migrate). Orphaned rows, which no
+    # endpoint can reach, are left behind instead of breaking the new keys.
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chat_logs'").fetchone()
+
+    conn.execute('''
+        CREATE TABLE chat_logs_new (
+            chatlogId INTEGER PRIMARY KEY AUTOINCREMENT,
+            userId TEXT NOT NULL,
+            profileId INTEGER NOT NULL,
+            summary TEXT,
+            summarizedThroughId INTEGER,
+            lastMessageId INTEGER NOT NULL DEFAULT -1,
+            FOREIGN KEY (userId, profileId) REFERENCES model_profiles (userId, profileId) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO chat_logs_new (chatlogId, userId, profileId, summary, summarizedThroughId, lastMessageId)
+        SELECT cl.chatlogId, cl.userId, cl.profileId, cl.summary, cl.summarizedThroughId, cl.lastMessageId
+        FROM chat_logs cl JOIN model_profiles mp ON cl.userId = mp.userId AND cl.profileId = mp.profileId
+    ''')
+    conn.execute('''
+        CREATE TABLE messages_new (
+            chatlogId INTEGER NOT NULL,
+            messageId INTEGER NOT NULL,
+            sender TEXT NOT NULL CHECK(sender IN ('user', 'llm')),
+            messageContent TEXT NOT NULL,
+            PRIMARY KEY (chatlogId, messageId),
+            FOREIGN KEY (chatlogId) REFERENCES chat_logs (chatlogId) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO messages_new (chatlogId, messageId, sender, messageContent)
+        SELECT chatlogId, messageId, sender, messageContent FROM messages
+        WHERE chatlogId IN (SELECT chatlogId FROM chat_logs_new)
+    ''')
+
+    conn.execute("DROP TABLE messages")
+    conn.execute("DROP TABLE chat_logs")
+    conn.execute("ALTER TABLE chat_logs_new RENAME TO chat_logs")
+    conn.execute("ALTER TABLE messages_new RENAME TO messages")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_logs_user_profile ON chat_logs (userId, profileId)")
+
+    # Keep AUTOINCREMENT from reusing ids of chats deleted before the rebuild.
+    if sequence is not None:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'chat_logs'", (sequence[0],))
+
+    violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+    if violations:
+        raise sqlite3.IntegrityError(f"Rebuilt tables have {len(violations)} foreign key violations")
+
+
+def _soft_deletes(conn):
+    # Deleted profiles and chats are hidden immediately and purged in batches
+    # by the deletions worker, which tracks its progress in deletion_jobs.
+    _add_missing_columns(conn, "model_profiles", [("deletedAt", "TEXT")])
+    _add_missing_columns(conn, "chat_logs", [("deletedAt", "TEXT")])
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS deletion_jobs (
+            jobId INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL CHECK(kind IN ('profile', 'chat')),
+            userId TEXT,
+            profileId INTEGER,
+            chatlogId INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'running', 'done', 'failed')),
+            totalMessages INTEGER,
+            deletedMessages INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            createdAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finishedAt TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_deletion_jobs_status ON deletion_jobs (status)")
+
+
+def _message_search(conn):
+    # Full-text index over message text. Each row's rowid is (chatlogId << 32) + messageId
+    # so the triggers can find it without a scan, and the owner column holds
+    # 'u' || hex(userId) so a search can be restricted to one user inside the
+    # index. Existing messages are indexed by `python search.py --backfill`.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            messageContent, owner, tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, messageContent, owner)
+            SELECT (new.chatlogId << 32) + new.messageId, new.messageContent, 'u' || hex(userId)
+            FROM chat_logs WHERE chatlogId = new.chatlogId;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = (old.chatlogId << 32) + old.messageId;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF messageContent ON messages BEGIN
+            UPDATE messages_fts SET messageContent = new.messageContent
+            WHERE rowid = (old.chatlogId << 32) + old.messageId;
+        END
+    ''')
+
+
+def _chat_archive(conn):
+    # Chats idle for ARCHIVE_AFTER_DAYS have their messages moved into one
+    # compressed blob in chat_archives (see archive.py). lastActiveAt is set
+    # when a chat is created and on every turn.
+    _add_missing_columns(conn, "chat_logs", [("lastActiveAt", "TEXT"), ("archivedAt", "TEXT")])
+    conn.execute("UPDATE chat_logs SET lastActiveAt = CURRENT_TIMESTAMP WHERE lastActiveAt IS NULL")
+    # ALTER TABLE cannot add a column defaulting to CURRENT_TIMESTAMP, so new rows get it from a trigger.
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_logs_last_active AFTER INSERT ON chat_logs
+        WHEN new.lastActiveAt IS NULL BEGIN
+            UPDATE chat_logs SET lastActiveAt = CURRENT_TIMESTAMP WHERE chatlogId = new.chatlogId;
+        END
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chat_logs_last_active ON chat_logs (lastActiveAt)
+        WHERE archivedAt IS NULL AND deletedAt IS NULL
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_archives (
+            chatlogId INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,
+            messageCount INTEGER NOT NULL,
+            rawBytes INTEGER NOT NULL,
+            storedBytes INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            archivedAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chatlogId) REFERENCES chat_logs (chatlogId) ON DELETE CASCADE
+        )
+    ''')
+
+
+def _llm_jobs(conn):
+    # Prompts submitted in job mode (see jobs.py). runAfter and leaseExpiresAt
+    # are Unix times; a NULL idempotencyKey never conflicts.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS llm_jobs (
+            jobId INTEGER PRIMARY KEY AUTOINCREMENT,
+            userId TEXT NOT NULL,
+            chatlogId INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            idempotencyKey TEXT,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued', 'running', 'done', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            runAfter REAL NOT NULL DEFAULT 0,
+            leaseExpiresAt REAL,
+            response TEXT,
+            error TEXT,
+            errorStatus INTEGER,
+            createdAt TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finishedAt TEXT,
+            UNIQUE (userId, idempotencyKey)
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_llm_jobs_pending ON llm_jobs (jobId)
+        WHERE status IN ('queued', 'running')
+    ''')
+
+
+def _user_tiers(conn):
+    # LLM rate-limit tier (see admission.py); NULL means LLM_DEFAULT_TIER.
+    _add_missing_columns(conn, "users", [("tier", "TEXT")])
+
+
+def _shard_rulesets(conn, ruleset_dir):
+    # Deployments from before the profileId counter keep their rulesets as flat
+    # files and have no counter row, so the first new profile would reuse id 0.
+    import migrate_rulesets
+
+    _, highest_id = migrate_rulesets.move_flat_files(ruleset_dir)
+    migrate_rulesets.seed_profile_counter(conn, highest_id)
+
+
+def _index_archived_chats(conn):
+    # Archiving moves a chat's messages out of `messages` but should leave them
+    # searchable, so the message triggers skip chats with a chat_archives row:
+    # archiving keeps the index rows and rehydrating doesn't add them twice.
+    # Deleting a chat log drops its index rows, archived or not.
+    import archive
+
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_insert")
+    conn.execute("DROP TRIGGER IF EXISTS messages_fts_delete")
+    conn.execute('''
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM chat_archives WHERE chatlogId = new.chatlogId) BEGIN
+            INSERT INTO messages_fts (rowid, messageContent, owner)
+            SELECT (new.chatlogId << 32) + new.messageId, new.messageContent, 'u' || hex(userId)
+            FROM chat_logs WHERE chatlogId = new.chatlogId;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM chat_archives WHERE chatlogId = old.chatlogId) BEGIN
+            DELETE FROM messages_fts WHERE rowid = (old.chatlogId << 32) + old.messageId;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chat_logs_fts_delete AFTER DELETE ON chat_logs BEGIN
+            DELETE FROM messages_fts
+            WHERE rowid BETWEEN old.chatlogId << 32 AND (old.chatlogId << 32) + 4294967295;
+        END
+    ''')
+
+    # Chats archived before this migration lost their index rows; put them back.
+    archived = conn.execute("""
+        SELECT ca.chatlogId, ca.codec, ca.data, 'u' || hex(cl.userId)
+        FROM chat_archives ca JOIN chat_logs cl ON cl.chatlogId = ca.chatlogId
+    """)
+    for chatlogId, codec, data, owner in archived.fetchall():
+        conn.execute(
+            "DELETE FROM messages_fts WHERE rowid BETWEEN ? AND ?",
+            (chatlogId << 32, (chatlogId << 32) + 0xFFFFFFFF)
+        )
+        conn.executemany(
+            "INSERT INTO messages_fts (rowid, messageContent, owner) VALUES (?, ?, ?)",
+            [((chatlogId << 32) + m["messageId"], m["messageContent"], owner) for m in archive.decode(codec, data)]
+        )
+
+
+MIGRATIONS = [
+    (1, "baseline schema", _baseline),
+    (2, "index chat_logs on (userId, profileId)", _index_chat_logs_by_profile),
+    (3, "chat_logs.lastMessageId counter", _add_last_message_id),
+    (4, "ON DELETE CASCADE foreign keys", _cascade_deletes),
+    (5, "soft deletes and deletion_jobs", _soft_deletes),
+    (6, "messages_fts full-text index", _message_search),
+    (7, "chat_archives cold storage", _chat_archive),
+    (8, "llm_jobs queue", _llm_jobs),
+    (9, "users.tier", _user_tiers),
+    (10, "sharded ruleset files and profileId counter", _shard_rulesets),
+    (11, "search index keeps archived chats", _index_archived_chats),
+]
+
+
+def current_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _ruleset_dir_for(db_path):
+    # The app's own database goes with RULESET_DIR (None); any other database
+    # with the rulesets directory next to it, as in the default layout.
+    if db_path is None or Path(db_path).resolve() == Path(db.DB_PATH).resolve():
+        return None
+    return Path(db_path).resolve().parent / "rulesets"
+
+
+def migrate(db_path=None, verbose=False, ruleset_dir=None):
+    """Apply every pending migration to the database and return the versions applied.
+    Migrations that move ruleset files work in `ruleset_dir`, which defaults to
+    the directory belonging to `db_path`."""
+    if ruleset_dir is None:
+        ruleset_dir = _ruleset_dir_for(db_path)
+    conn = sqlite3.connect(db_path or db.DB_PATH, isolation_level=None, timeout=db.BUSY_TIMEOUT_MS / 1000)
+    applied = []
+    try:
+        # Table rebuilds must not trigger cascades; this pragma is a no-op inside a transaction.
+        conn.execute("PRAGMA foreign_keys=OFF")
+        for version, name, apply in MIGRATIONS:
+            # BEGIN IMMEDIATE serialises concurrent runners, e.g. several workers starting at once.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if current_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                if apply is _shard_rulesets:
+                    apply(conn, ruleset_dir)
+                else:
+                    apply(conn)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied.append(version)
+            if verbose:
+                print(f"Applied migration {version}: {name}")
+    finally:
+        conn.close()
+    return applied
+
+
+if __name__ == "__main__":
+    applied = migrate(sys.argv[1] if len(sys.argv) > 1 else None, verbose=True)
+    if not applied:
+        print("Database schema is up to date.")
@@ -0,0 +1,98 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+import metrics
+
+# bcrypt is deliberately slow and holds the GIL, so hashing and verification
+# run in a pool of worker processes instead of on the server's own threads.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_MAX_PENDING = int(os.getenv("PASSWORD_MAX_PENDING", "64"))
+PASSWORD_RETRY_AFTER_SECONDS = int(os.getenv("PASSWORD_RETRY_AFTER_SECONDS", "2"))
+
+# Pinning min and max rounds to the configured cost makes verify_and_update
+# flag any hash made with a different cost factor so login can rehash it.
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = None
+_pending = 0
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str):
+    return pwd_context.verify_and_update(password, hashed)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn avoids forking a process that already runs the server's threads.
+        _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def _discard_broken(executor: ProcessPoolExecutor):
+    # Concurrent requests see the same broken pool; only the first replaces it.
+    global _executor
+    if _executor is executor:
+        _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def _submit(func, *args):
+    global _pending
+    if _pending >= PASSWORD_MAX_PENDING:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many sign-in requests in progress. Please retry shortly.",
+            headers={"Retry-After": str(PASSWORD_RETRY_AFTER_SECONDS)}
+        )
+    _pending += 1
+    try:
+        # A worker that dies (e.g. OOM-killed) breaks the whole pool; start a new one and retry once.
+        for attempt in range(2):
+            executor = _get_executor()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+            except BrokenProcessPool:
+                _discard_broken(executor)
+        raise HTTPException(
+            status_code=503,
+            detail="Password service is unavailable. Please retry shortly.",
+            headers={"Retry-After": str(PASSWORD_RETRY_AFTER_SECONDS)}
+        )
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    with metrics.span("password.hash"):
+        return await _submit(_hash, password)
+
+
+async def verify_password(password: str, hashed: str):
+    """Return (valid, new_hash). new_hash is set when the stored hash should be replaced."""
+    with metrics.span("password.verify"):
+        return await _submit(_verify_and_update, password, hashed)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
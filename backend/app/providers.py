@@ -0,0 +1,125 @@
+import asyncio
+import os
+import threading
+
+import metrics
+
+# The LLM backend, chosen with LLM_PROVIDER. A provider is created on first use
+# or by the startup warm-up (see llm.warm_up), so importing the app neither
+# loads the Gemini SDK nor needs an API key.
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+STUB_LATENCY_MS = float(os.getenv("STUB_LLM_LATENCY_MS", "0"))
+
+
+class GeminiProvider:
+    name = "gemini"
+
+    def __init__(self):
+        import google.generativeai as genai
+
+        api_key = os.getenv("API_KEY")
+        if api_key is None:
+            raise ValueError("API_KEY environment variable not set")
+        genai.configure(api_key=api_key)
+        self._genai = genai
+
+    def build_model(self, model_name, system_instruction=None, generation_config=None):
+        return self._genai.GenerativeModel(
+            model_name=model_name,
+            system_instruction=system_instruction,
+            generation_config=generation_config
+        )
+
+
+class StubResponse:
+    def __init__(self, text):
+        self.text = text
+        self.candidates = []
+        self.usage_metadata = None
+
+
+class _StubStream:
+    def __init__(self, text):
+        self._words = text.split(" ")
+
+    async def __aiter__(self):
+        for start in range(0, len(self._words), 4):
+            await asyncio.sleep(0)
+            end = start + 4
+            yield StubResponse(" ".join(self._words[start:end]) + (" " if end < len(self._words) else ""))
+
+
+class _StubChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, prompt, stream=False):
+        text = await self.model.reply(prompt)
+        return _StubStream(text) if stream else StubResponse(text)
+
+
+class StubModel:
+    """Answers in-process with a canned echo of the prompt, for local development
+    and tests. STUB_LLM_LATENCY_MS adds a delay to each call."""
+
+    def __init__(self, model_name, system_instruction=None, generation_config=None):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+
+    def start_chat(self, history=None):
+        return _StubChatSession(self, history)
+
+    async def generate_content_async(self, contents):
+        return StubResponse(await self.reply(contents))
+
+    async def reply(self, contents):
+        if STUB_LATENCY_MS:
+            await asyncio.sleep(STUB_LATENCY_MS / 1000)
+        if not isinstance(contents, str):
+            contents = " ".join(str(part) for part in contents)
+        return f"[{self.model_name} stub] You said: {contents}"
+
+
+class StubProvider:
+    name = "stub"
+
+    def build_model(self, model_name, system_instruction=None, generation_config=None):
+        return StubModel(model_name, system_instruction, generation_config)
+
+
+PROVIDERS = {"gemini": GeminiProvider, "stub": StubProvider}
+
+_provider = None
+_lock = threading.Lock()
+
+
+def check_config():
+    """Fail fast on a bad configuration without creating the provider."""
+    if _provider is not None:
+        return
+    if LLM_PROVIDER not in PROVIDERS:
+        raise ValueError(f"Unknown LLM_PROVIDER {LLM_PROVIDER!r}; expected one of {', '.join(PROVIDERS)}")
+    if LLM_PROVIDER == "gemini" and os.getenv("API_KEY") is None:
+        raise ValueError("API_KEY environment variable not set")
+
+
+def get():
+    """Return the configured provider, creating it on the first call. Thread-safe,
+    since models are built from the threadpool."""
+    global _provider
+    if _provider is None:
+        with _lock:
+            if _provider is None:
+                check_config()
+                with metrics.span("llm.provider_init"):
+                    _provider = PROVIDERS[LLM_PROVIDER]()
+    return _provider
+
+
+def install(provider):
+    """Use `provider` instead of the configured one, e.g. a fake in benchmarks."""
+    global _provider
+    with _lock:
+        _provider = provider
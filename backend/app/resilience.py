@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+
+from fastapi import HTTPException
+
+import metrics
+
+# Upstream LLM calls are made through call(): each attempt gets its own
+# deadline, retryable failures are retried with jittered backoff inside the
+# caller's overall budget, and a slow attempt can be hedged with a second one.
+# A circuit breaker counts consecutive failed attempts and, once open, fails
+# calls fast with 503 until a probe call succeeds.
+LLM_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "20"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+# Hedging sends a second copy of a slow request, so it costs upstream quota; off by default.
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "0.5"))
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_LATENCY_WINDOW = 200
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+# Gemini's errors carry the HTTP status as `code`.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+ATTEMPTS = metrics.Counter("llm_attempts_total", "Upstream LLM attempts by kind and outcome.", ["kind", "outcome"])
+HEDGES = metrics.Counter("llm_hedges_total", "Hedged LLM attempts by which copy answered first (none if neither did).", ["winner"])
+BREAKER_OPENED = metrics.Counter("llm_breaker_opened_total", "Times the LLM circuit breaker opened.")
+BREAKER_REJECTED = metrics.Counter("llm_breaker_rejected_total", "LLM calls failed fast by the open circuit breaker.")
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUSES
+
+
+def backoff(attempt: int) -> float:
+    """Full jitter: a random delay up to base * 2^(attempt - 1)."""
+    return random.uniform(0, LLM_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failed attempts. While open,
+    calls are rejected; after `reset_seconds` one probe call is let through
+    (half-open) and its outcome closes or reopens the breaker."""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def _reject(self, retry_after: float):
+        BREAKER_REJECTED.inc()
+        raise HTTPException(
+            status_code=503,
+            detail="The LLM service is unavailable right now. Please retry shortly.",
+            headers={"Retry-After": str(max(int(retry_after + 0.999), 1))}
+        )
+
+    def check(self):
+        """Raise 503 if the breaker is open, without taking the half-open probe."""
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                self._reject(remaining)
+
+    def before_call(self):
+        self.check()
+        if self.state == "open":
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                self._reject(1)
+            self._probing = True
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("LLM circuit breaker closed")
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            logger.warning("LLM circuit breaker opened after %d failed attempts", self.failures)
+            BREAKER_OPENED.inc()
+            self.state = "open"
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+    def release_probe(self):
+        # A probe that was cancelled tells us nothing; let the next call probe.
+        self._probing = False
+
+
+class LatencyTracker:
+    """Recent successful attempt latencies, used to pick the hedging delay."""
+
+    def __init__(self, size: int):
+        self._samples = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def hedge_delay(self):
+        if len(self._samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return max(samples[int((len(samples) - 1) * LLM_HEDGE_QUANTILE)], LLM_HEDGE_MIN_DELAY_SECONDS)
+
+
+breaker = CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS)
+latency = LatencyTracker(LLM_LATENCY_WINDOW)
+
+metrics.Gauge(
+    "llm_breaker_state", "1 for the LLM circuit breaker's current state.",
+    lambda: {(state,): int(breaker.state == state) for state in ("closed", "half_open", "open")}, ["state"]
+)
+
+
+async def _hedged(make_call, timeout: float, delay: float, try_slot):
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    primary = asyncio.ensure_future(make_call())
+    tasks = [primary]
+    release = None
+    winner = "none"
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=min(delay, timeout))
+        if not done:
+            # Only hedge with a slot nobody is waiting for.
+            release = try_slot()
+            if release is not None:
+                tasks.append(asyncio.ensure_future(make_call()))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, timeout=max(started + timeout - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                raise asyncio.TimeoutError()
+            for task in done:
+                if task.exception() is None:
+                    winner = "primary" if task is primary else "hedge"
+                    latency.observe(loop.time() - started)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+        if release is not None:
+            release()
+        if len(tasks) > 1:
+            HEDGES.inc(winner=winner)
+
+
+async def call(make_call, deadline: float, try_slot=None):
+    """Await `make_call()` with retries until the loop time `deadline`, raising
+    asyncio.TimeoutError if it runs out. Pass `try_slot`, a function returning a
+    release function or None, to allow hedging; without it latencies aren't
+    tracked, so calls of a different shape (streams, summaries) don't skew the
+    hedging delay."""
+    loop = asyncio.get_running_loop()
+    for attempt in range(1, LLM_MAX_ATTEMPTS + 1):
+        breaker.before_call()
+        kind = "first" if attempt == 1 else "retry"
+        timeout = min(LLM_ATTEMPT_TIMEOUT_SECONDS, deadline - loop.time())
+        try:
+            if timeout <= 0:
+                raise asyncio.TimeoutError()
+            delay = latency.hedge_delay() if try_slot is not None and LLM_HEDGE else None
+            if delay is not None and delay < timeout:
+                result = await _hedged(make_call, timeout, delay, try_slot)
+            else:
+                started = loop.time()
+                result = await asyncio.wait_for(make_call(), timeout)
+                if try_slot is not None:
+                    latency.observe(loop.time() - started)
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            ATTEMPTS.inc(kind=kind, outcome="cancelled")
+            raise
+        except Exception as e:
+            if not is_retryable(e):
+                # The upstream answered, e.g. rejecting the prompt; it is healthy.
+                breaker.record_success()
+                ATTEMPTS.inc(kind=kind, outcome="rejected")
+                raise
+            breaker.record_failure()
+            ATTEMPTS.inc(kind=kind, outcome="timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+            pause = backoff(attempt)
+            if attempt == LLM_MAX_ATTEMPTS or loop.time() + pause >= deadline:
+                raise
+            logger.info("LLM attempt %d failed (%r); retrying in %.2fs", attempt, e, pause)
+            await asyncio.sleep(pause)
+            continue
+        breaker.record_success()
+        ATTEMPTS.inc(kind=kind, outcome="ok")
+        return result
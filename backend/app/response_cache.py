@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from starlette.concurrency import run_in_threadpool
+
+import llm
+import metrics
+from cache import LRUCache
+
+# Identical requests (same system prompt, model, generation config, history and
+# prompt) are answered from a cache instead of calling Gemini again, and
+# identical requests that arrive while one is already in flight wait for that
+# call instead of starting their own.
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")  # memory, disk or off
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+LLM_CACHE_DIR = Path(os.getenv("LLM_CACHE_DIR", Path(__file__).parent.resolve() / "llm_cache"))
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(system_prompt: str, history, prompt: str) -> str:
+    payload = json.dumps({
+        "system_prompt": system_prompt,
+        "model": llm.MODEL_NAME,
+        "generation_config": llm.GENERATION_CONFIG,
+        "history": history,
+        "prompt": prompt,
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = LRUCache(maxsize, ttl=ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def delete(self, key):
+        self._cache.pop(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class DiskBackend:
+    """Stores one file per response so the cache survives restarts and is shared by workers.
+
+    A read touches the file's mtime, so pruning the oldest files evicts the least
+    recently used entries.
+    """
+
+    PRUNE_EVERY = 64
+
+    def __init__(self, directory: Path, maxsize: int, ttl: float):
+        self.directory = Path(directory)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        return self.directory / key[:2] / f"{key}.json"
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path)
+            return value
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_EVERY == 0
+        if prune:
+            self.prune()
+
+    def delete(self, key):
+        self._path(key).unlink(missing_ok=True)
+
+    def _entries(self):
+        return list(self.directory.glob("*/*.json"))
+
+    def prune(self):
+        entries = []
+        now = time.time()
+        for path in self._entries():
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if now - mtime > self.ttl:
+                path.unlink(missing_ok=True)
+            else:
+                entries.append((mtime, path))
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.maxsize, 0)]:
+            path.unlink(missing_ok=True)
+
+    def clear(self):
+        for path in self._entries():
+            path.unlink(missing_ok=True)
+
+    def __len__(self):
+        return len(self._entries())
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inflight = {}
+
+    async def get_or_compute(self, key: str, compute):
+        """Return the cached response for key, or await compute() exactly once for
+        every concurrent caller with the same key. Failures are not cached."""
+        if self.backend is None:
+            self.misses += 1
+            return await compute()
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        value = await run_in_threadpool(self.backend.get, key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        # Another caller may have started the same call while we read the backend.
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        # The upstream call runs in its own task so a disconnecting leader does
+        # not cancel it for the callers waiting on the same result.
+        task = asyncio.ensure_future(self._compute_and_store(key, compute))
+        self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _compute_and_store(self, key, compute):
+        try:
+            value = await compute()
+            await self.store(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    async def lookup(self, key: str):
+        if self.backend is None:
+            return None
+        value = await run_in_threadpool(self.backend.get, key)
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    async def store(self, key: str, value):
+        if self.backend is None:
+            return
+        try:
+            await run_in_threadpool(self.backend.set, key, value)
+        except OSError:
+            # A full or read-only cache directory must not fail the request.
+            logger.exception("Could not store LLM response in the cache")
+
+    async def discard(self, key: str):
+        """Drop a response that turned out not to belong to any chat, e.g. because
+        the chat was deleted while the LLM was answering."""
+        if self.backend is None:
+            return
+        await run_in_threadpool(self.backend.delete, key)
+
+    def stats(self):
+        return {
+            "backend": LLM_CACHE_BACKEND,
+            "entries": len(self.backend) if self.backend is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+        }
+
+
+def _build_backend():
+    if LLM_CACHE_BACKEND == "disk":
+        return DiskBackend(LLM_CACHE_DIR, LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS)
+    if LLM_CACHE_BACKEND == "memory":
+        return MemoryBackend(LLM_CACHE_SIZE, LLM_CACHE_TTL_SECONDS)
+    return None
+
+
+cache = ResponseCache(_build_backend())
+
+metrics.Gauge(
+    "llm_cache_lookups_total", "LLM response cache lookups by result.",
+    lambda: {("hit",): cache.hits, ("miss",): cache.misses, ("coalesced",): cache.coalesced},
+    labelnames=["result"], kind="counter"
+)
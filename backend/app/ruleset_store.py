@@ -0,0 +1,126 @@
+import json
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import db
+import llm
+import metrics
+from cache import LRUCache
+
+# Parsed rulesets, their system prompts and the configured model are kept in
+# memory so repeat chat turns skip the file read, the JSON work and building a
+# new GenerativeModel. The file mtime is re-checked at most once per interval
+# as a fallback for edits made outside the API.
+UPLOAD_DIR = Path(os.getenv("RULESET_DIR", Path(__file__).parent.resolve() / "rulesets"))
+RULESET_CACHE_SIZE = int(os.getenv("RULESET_CACHE_SIZE", "512"))
+RULESET_REVALIDATE_SECONDS = float(os.getenv("RULESET_REVALIDATE_SECONDS", "30"))
+# Ruleset files are spread over this many subdirectories so no single
+# directory grows with the total number of profiles.
+RULESET_SHARDS = 256
+
+
+@dataclass
+class CachedRuleset:
+    ruleset: dict
+    system_prompt: str
+    model: object
+    mtime: float
+    checked_at: float
+
+
+_cache = LRUCache(RULESET_CACHE_SIZE)
+
+
+def allocate_profile_id() -> int:
+    """Hand out the next profileId from a database counter, safe under concurrent creation."""
+    with db.connection() as conn:
+        row = conn.execute("""
+            INSERT INTO counters (name, value) VALUES ('profileId', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1
+            RETURNING value
+        """).fetchone()
+        conn.commit()
+    return row[0] - 1
+
+
+def shard_dir(profileId: int, root=None) -> Path:
+    return Path(root or UPLOAD_DIR) / f"{profileId % RULESET_SHARDS:02x}"
+
+
+def ruleset_path(userId: str, profileId: int, root=None) -> Path:
+    return shard_dir(profileId, root) / f"{userId}_{profileId}.json"
+
+
+def save(userId: str, profileId: int, ruleset: dict) -> Path:
+    """Write a ruleset file atomically: readers see either the old file or the complete new one."""
+    file_path = ruleset_path(userId, profileId)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(ruleset, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    invalidate(userId, profileId)
+    return file_path
+
+
+def delete(userId: str, profileId: int):
+    file_path = ruleset_path(userId, profileId)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    invalidate(userId, profileId)
+
+
+def _load(userId: str, profileId: int) -> CachedRuleset:
+    file_path = ruleset_path(userId, profileId)
+    with metrics.span("ruleset.read_file"):
+        mtime = file_path.stat().st_mtime
+        with open(file_path, "r") as f:
+            ruleset = json.load(f)
+
+    system_prompt = f"You must strictly follow these rules: {json.dumps(ruleset)}"
+    with metrics.span("llm.build_model"):
+        model = llm.build_model(system_prompt)
+    return CachedRuleset(
+        ruleset=ruleset,
+        system_prompt=system_prompt,
+        model=model,
+        mtime=mtime,
+        checked_at=time.monotonic(),
+    )
+
+
+def get(userId: str, profileId: int) -> CachedRuleset:
+    """Return the cached ruleset for a profile. Raises FileNotFoundError if it has no ruleset file."""
+    key = (userId, profileId)
+    entry = _cache.get(key)
+
+    if entry is not None:
+        now = time.monotonic()
+        if now - entry.checked_at < RULESET_REVALIDATE_SECONDS:
+            return entry
+        try:
+            mtime = ruleset_path(userId, profileId).stat().st_mtime
+        except FileNotFoundError:
+            _cache.pop(key)
+            raise
+        if mtime == entry.mtime:
+            entry.checked_at = now
+            return entry
+
+    entry = _load(userId, profileId)
+    _cache.set(key, entry)
+    return entry
+
+
+def invalidate(userId: str, profileId: int):
+    _cache.pop((userId, profileId))
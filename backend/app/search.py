@@ -0,0 +1,210 @@
+import argparse
+import math
+import re
+import sqlite3
+import time
+import unicodedata
+
+import archive
+import db
+import migrations
+
+# Search over a user's messages using the messages_fts index (see migrations).
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_CANDIDATES = 1000
+BACKFILL_BATCH_CHATS = 200
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_WORD = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def owner_token(userId: str) -> str:
+    # Matches 'u' || hex(userId) in the index triggers.
+    return "u" + userId.encode("utf-8").hex().upper()
+
+
+def _normalize(text: str) -> str:
+    # Lower-case and strip accents the way the index's unicode61 tokenizer does.
+    text = text.lower()
+    if not text.isascii():
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return text
+
+
+def query_terms(query: str):
+    return list(dict.fromkeys(_WORD.findall(_normalize(query))))
+
+
+def build_match(terms) -> str:
+    """Every term must appear. Terms are quoted, so operators, column filters and
+    prefix stars typed by the user are plain words and no input is a syntax error.
+    Prefix queries are not offered: FTS5 merges the whole doclist of every
+    matching word, which is too slow at millions of messages."""
+    return " AND ".join(f'"{term}"' for term in terms)
+
+
+def _rank(rows, terms):
+    """Order candidates by BM25, taking document frequencies from the candidate
+    set. FTS5's own bm25() reads every document containing each term to get
+    them, which costs tens of milliseconds for common words at millions of rows."""
+    if not rows:
+        return []
+    docs = []
+    doc_freq = [0] * len(terms)
+    for row in rows:
+        text = _normalize(row["messageContent"])
+        # Substring counts stand in for term frequencies; a regex per term costs
+        # more than the whole index lookup.
+        tf = [text.count(term) for term in terms]
+        for i, n in enumerate(tf):
+            doc_freq[i] += n > 0
+        docs.append((row, text.count(" ") + 1, tf))
+
+    avg_len = sum(length for _, length, _ in docs) / len(docs)
+    idf = [math.log(1 + (len(docs) - df + 0.5) / (df + 0.5)) for df in doc_freq]
+    scored = []
+    for row, length, tf in docs:
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_len)
+        score = sum(weight * n * (BM25_K1 + 1) / (n + norm) for weight, n in zip(idf, tf))
+        scored.append((-score, -row["rowid"], row))
+    scored.sort(key=lambda item: item[:2])
+    return [row for _, _, row in scored]
+
+
+def search(cursor, userId: str, query: str, limit: int, offset: int, profileId=None, before=None):
+    """Return up to `limit` of the user's messages matching `query` and the
+    {"offset", "before"} of the next page, or None after the last one.
+
+    Matches are ranked best first within windows of SEARCH_CANDIDATES, newest
+    window first: a window holds the newest matches with rowid below `before`,
+    and once it is used up the next page starts the window below it. So older
+    matches are always reachable, and only the last page of a window may come
+    back short. The first page (`before` None) pins its window just above the
+    newest match, so messages written while paging don't shift it."""
+    terms = query_terms(query)
+    if not terms:
+        return [], None
+    match = f"owner : {owner_token(userId)} AND messageContent : ({build_match(terms)})"
+
+    sql = """
+        SELECT f.rowid, f.messageContent, cl.profileId, cl.lastMessageId
+        FROM messages_fts f
+        JOIN chat_logs cl ON cl.chatlogId = f.rowid >> 32
+        WHERE messages_fts MATCH ? AND cl.deletedAt IS NULL
+    """
+    params = [match]
+    if profileId is not None:
+        sql += " AND cl.profileId = ?"
+        params.append(profileId)
+    if before is not None:
+        sql += " AND f.rowid < ?"
+        params.append(before)
+    sql += " ORDER BY f.rowid DESC LIMIT ?"
+    params.append(SEARCH_CANDIDATES + 1)
+
+    window = cursor.execute(sql, params).fetchall()
+    older = len(window) > SEARCH_CANDIDATES
+    window = window[:SEARCH_CANDIDATES]
+    if before is None and window:
+        before = window[0]["rowid"] + 1
+    ranked = _rank(window, terms)
+    page = ranked[offset:offset + limit]
+
+    if offset + limit < len(ranked):
+        next_page = {"offset": offset + limit, "before": before}
+    elif older:
+        next_page = {"offset": 0, "before": window[-1]["rowid"]}
+    else:
+        next_page = None
+    if not page:
+        return [], next_page
+
+    # Snippets and senders only for the rows on this page. Archived chats have
+    # no `messages` rows, so their senders come from the archive.
+    rowids = [row["rowid"] for row in page]
+    placeholders = ",".join("?" * len(rowids))
+    details = {row["rowid"]: row for row in cursor.execute(f"""
+        SELECT f.rowid, snippet(messages_fts, 0, '<mark>', '</mark>', '…', 16) AS snippet, m.sender
+        FROM messages_fts f
+        LEFT JOIN messages m ON m.chatlogId = f.rowid >> 32 AND m.messageId = f.rowid & 4294967295
+        WHERE messages_fts MATCH ? AND f.rowid IN ({placeholders})
+    """, [match, *rowids])}
+    archived_senders = {}
+
+    results = []
+    for row in page:
+        detail = details.get(row["rowid"])
+        if detail is None:
+            continue
+        chatlogId, messageId = row["rowid"] >> 32, row["rowid"] & 0xFFFFFFFF
+        sender = detail["sender"]
+        if sender is None:
+            if chatlogId not in archived_senders:
+                archived_senders[chatlogId] = {
+                    m["messageId"]: m["sender"]
+                    for m in archive.load_messages(cursor, chatlogId, row["lastMessageId"])
+                }
+            sender = archived_senders[chatlogId].get(messageId)
+            if sender is None:
+                continue
+        results.append({
+            "chatlogId": chatlogId,
+            "messageId": messageId,
+            "profileId": row["profileId"],
+            "sender": sender,
+            "snippet": detail["snippet"],
+        })
+    return results, next_page
+
+
+def backfill(db_path=None, batch_chats=BACKFILL_BATCH_CHATS, verbose=False, ruleset_dir=None):
+    """Index messages written before the search migration. Safe to re-run or interrupt:
+    rows already in the index are skipped, and each batch of chats commits on its own."""
+    migrations.migrate(db_path, ruleset_dir=ruleset_dir)
+    conn = sqlite3.connect(db_path or db.DB_PATH, timeout=db.BUSY_TIMEOUT_MS / 1000)
+    indexed = 0
+    try:
+        last_chatlogId = -1
+        while True:
+            chatlog_ids = [row[0] for row in conn.execute(
+                "SELECT chatlogId FROM chat_logs WHERE chatlogId > ? ORDER BY chatlogId LIMIT ?",
+                (last_chatlogId, batch_chats)
+            )]
+            if not chatlog_ids:
+                break
+            cursor = conn.execute("""
+                INSERT INTO messages_fts (rowid, messageContent, owner)
+                SELECT (m.chatlogId << 32) + m.messageId, m.messageContent, 'u' || hex(cl.userId)
+                FROM messages m JOIN chat_logs cl ON cl.chatlogId = m.chatlogId
+                WHERE m.chatlogId BETWEEN ? AND ?
+                  AND NOT EXISTS (SELECT 1 FROM messages_fts WHERE rowid = (m.chatlogId << 32) + m.messageId)
+            """, (chatlog_ids[0], chatlog_ids[-1]))
+            conn.commit()
+            indexed += cursor.rowcount
+            last_chatlogId = chatlog_ids[-1]
+            if verbose:
+                print(f"Indexed chats up to {last_chatlogId} ({indexed} messages so far)")
+
+        # Merge the index segments written by the batches.
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        conn.commit()
+    finally:
+        conn.close()
+    return indexed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the chat message search index.")
+    parser.add_argument("--backfill", action="store_true", help="Index messages that predate the search index")
+    parser.add_argument("--db-path")
+    parser.add_argument("--ruleset-dir", help="Rulesets of --db-path (default: rulesets next to it)")
+    parser.add_argument("--batch-chats", type=int, default=BACKFILL_BATCH_CHATS)
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.error("nothing to do; pass --backfill")
+
+    started = time.perf_counter()
+    count = backfill(args.db_path, args.batch_chats, verbose=True, ruleset_dir=args.ruleset_dir)
+    print(f"Indexed {count} messages in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,322 @@
+import json
+import os
+import sqlite3
+
+from fastapi import HTTPException
+
+import archive
+import db
+import deletions
+import metrics
+import ruleset_store
+
+# Bulk export and import of a user's profiles, rulesets, chats and messages as
+# NDJSON, one record per line:
+#   {"type": "export", "version": 1, "userId": ...}
+#   {"type": "profile", "profileId", "profileName", "model", "ruleset"}
+#   {"type": "chat", "chatlogId", "profileId", "summary", "summarizedThroughId", "lastMessageId"}
+#   {"type": "message", "chatlogId", "messageId", "sender", "messageContent"}
+# A profile comes before its chats and a chat before its messages. Both
+# directions stream, so memory stays flat however much a user has stored.
+EXPORT_VERSION = 1
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(64 * 1024)))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "5000"))
+IMPORT_BATCH_BYTES = int(os.getenv("IMPORT_BATCH_BYTES", str(8 * 1024 * 1024)))
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+
+
+def _read_ruleset(userId: str, profileId: int):
+    try:
+        with open(ruleset_store.ruleset_path(userId, profileId), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _records(conn, userId: str):
+    yield {"type": "export", "version": EXPORT_VERSION, "userId": userId}
+
+    profiles = conn.execute("""
+        SELECT profileId, profileName, model FROM model_profiles
+        WHERE userId = ? AND deletedAt IS NULL ORDER BY profileId
+    """, (userId,)).fetchall()
+    for profile in profiles:
+        yield {"type": "profile", **dict(profile), "ruleset": _read_ruleset(userId, profile["profileId"])}
+
+        chats = conn.execute("""
+            SELECT chatlogId, profileId, summary, summarizedThroughId, lastMessageId, archivedAt FROM chat_logs
+            WHERE userId = ? AND profileId = ? AND deletedAt IS NULL ORDER BY chatlogId
+        """, (userId, profile["profileId"])).fetchall()
+        for chat in chats:
+            chat = dict(chat)
+            archived = chat.pop("archivedAt") is not None
+            yield {"type": "chat", **chat}
+            if archived:
+                messages = archive.load_messages(conn, chat["chatlogId"], chat["lastMessageId"])
+            else:
+                # Rows are stepped one at a time rather than fetched all at once.
+                messages = conn.execute(
+                    "SELECT messageId, sender, messageContent FROM messages WHERE chatlogId = ? ORDER BY messageId",
+                    (chat["chatlogId"],)
+                )
+            for message in messages:
+                yield {"type": "message", "chatlogId": chat["chatlogId"], **dict(message)}
+
+
+def export_user(userId: str):
+    """Yield a user's data as NDJSON in chunks of about EXPORT_CHUNK_BYTES.
+
+    Uses its own connection rather than a pooled one, since a large export can
+    stream for minutes, and reads inside one transaction so the export is a
+    consistent snapshot even while the user keeps chatting."""
+    conn = sqlite3.connect(db.DB_PATH, timeout=db.BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("BEGIN")
+        buffer = []
+        size = 0
+        for record in _records(conn, userId):
+            line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+            buffer.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_BYTES:
+                yield b"".join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield b"".join(buffer)
+    finally:
+        conn.close()
+
+
+def _invalid(line_no: int, detail: str):
+    return HTTPException(status_code=400, detail=f"Line {line_no}: {detail}")
+
+
+def _field(record, line_no, name, types, required=True):
+    value = record.get(name)
+    if value is None and not required:
+        return None
+    # bool is an int subclass, but never a valid id.
+    if not isinstance(value, types) or isinstance(value, bool):
+        raise _invalid(line_no, f"'{name}' is missing or has the wrong type")
+    return value
+
+
+class Importer:
+    """Writes an export stream into a user's account under new profile and chat ids.
+
+    Records are parsed and written a batch at a time, each batch in one
+    transaction with executemany. Imported profiles and chats stay hidden
+    (deletedAt set) until the whole stream has been written, so a failed
+    import never shows partial data; its rows are handed to the deletions
+    worker instead."""
+
+    def __init__(self, userId: str):
+        self.userId = userId
+        self.profile_ids = {}
+        self.chatlog_ids = {}
+        self.last_message_ids = {}
+        self.messages = 0
+        self._seen_profiles = set()
+        self._seen_chats = {}
+
+    def _parse(self, lines):
+        profiles, chats, messages = [], [], []
+        for line_no, raw in lines:
+            try:
+                record = json.loads(raw)
+            except ValueError as e:
+                raise _invalid(line_no, f"invalid JSON: {e}")
+            if not isinstance(record, dict):
+                raise _invalid(line_no, "expected a JSON object")
+
+            kind = record.get("type")
+            if kind == "message":
+                chatlogId = _field(record, line_no, "chatlogId", int)
+                if chatlogId not in self._seen_chats:
+                    raise _invalid(line_no, f"message for chat {chatlogId} that was not declared earlier")
+                messageId = _field(record, line_no, "messageId", int)
+                sender = record.get("sender")
+                if sender not in ("user", "llm"):
+                    raise _invalid(line_no, "'sender' must be 'user' or 'llm'")
+                messages.append((chatlogId, messageId, sender, _field(record, line_no, "messageContent", str)))
+            elif kind == "chat":
+                chatlogId = _field(record, line_no, "chatlogId", int)
+                profileId = _field(record, line_no, "profileId", int)
+                if profileId not in self._seen_profiles:
+                    raise _invalid(line_no, f"chat for profile {profileId} that was not declared earlier")
+                if chatlogId in self._seen_chats:
+                    raise _invalid(line_no, f"chat {chatlogId} appears twice")
+                self._seen_chats[chatlogId] = profileId
+                chats.append((
+                    chatlogId, profileId,
+                    _field(record, line_no, "summary", str, required=False),
+                    _field(record, line_no, "summarizedThroughId", int, required=False),
+                    _field(record, line_no, "lastMessageId", int, required=False),
+                ))
+            elif kind == "profile":
+                profileId = _field(record, line_no, "profileId", int)
+                if profileId in self._seen_profiles:
+                    raise _invalid(line_no, f"profile {profileId} appears twice")
+                profileName = _field(record, line_no, "profileName", str)
+                model = _field(record, line_no, "model", str)
+                ruleset = record.get("ruleset")
+                if not isinstance(ruleset, dict) or not ruleset or not profileName.strip() or not model:
+                    raise _invalid(line_no, "a profile needs a profileName, a model and a non-empty ruleset")
+                self._seen_profiles.add(profileId)
+                profiles.append((profileId, profileName, model, ruleset))
+            elif kind == "export":
+                if record.get("version") != EXPORT_VERSION:
+                    raise _invalid(line_no, f"unsupported export version {record.get('version')!r}")
+            else:
+                raise _invalid(line_no, f"unknown record type {kind!r}")
+        return profiles, chats, messages
+
+    def write_batch(self, lines):
+        """Parse and store one batch of (line number, bytes) pairs. Runs on the threadpool."""
+        profiles, chats, messages = self._parse(lines)
+        new_profiles = {}
+        new_chats = {}
+        with db.connection() as conn, metrics.span("import.write_batch"):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                if profiles:
+                    # Reserve a block of ids from the same counter allocate_profile_id uses.
+                    last = conn.execute("""
+                        INSERT INTO counters (name, value) VALUES ('profileId', ?)
+                        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+                        RETURNING value
+                    """, (len(profiles),)).fetchone()[0]
+                    first = last - len(profiles)
+                    new_profiles = {old: first + i for i, (old, _, _, _) in enumerate(profiles)}
+                    conn.executemany(
+                        "INSERT INTO model_profiles (userId, profileId, profileName, model, deletedAt) VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                        [(self.userId, new_profiles[old], name, model) for old, name, model, _ in profiles]
+                    )
+                if chats:
+                    # The write lock is held, so ids past the AUTOINCREMENT high-water mark are ours.
+                    first = conn.execute("""
+                        SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'chat_logs'), 0),
+                                   IFNULL((SELECT MAX(chatlogId) FROM chat_logs), 0)) + 1
+                    """).fetchone()[0]
+                    new_chats = {chat[0]: first + i for i, chat in enumerate(chats)}
+                    all_profiles = {**self.profile_ids, **new_profiles}
+                    conn.executemany("""
+                        INSERT INTO chat_logs (chatlogId, userId, profileId, summary, summarizedThroughId, lastMessageId, deletedAt)
+                        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    """, [
+                        (new_chats[old], self.userId, all_profiles[profileId], summary, summarized, -1 if last_id is None else last_id)
+                        for old, profileId, summary, summarized, last_id in chats
+                    ])
+                if messages:
+                    all_chats = {**self.chatlog_ids, **new_chats}
+                    conn.executemany(
+                        "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+                        [(all_chats[old], messageId, sender, content) for old, messageId, sender, content in messages]
+                    )
+                conn.commit()
+            except sqlite3.IntegrityError as e:
+                conn.rollback()
+                raise HTTPException(status_code=400, detail=f"Import rejected: {e}")
+            except BaseException:
+                conn.rollback()
+                raise
+
+        self.profile_ids.update(new_profiles)
+        self.chatlog_ids.update(new_chats)
+        for old, messageId, _, _ in messages:
+            chatlogId = self.chatlog_ids[old]
+            if messageId > self.last_message_ids.get(chatlogId, -1):
+                self.last_message_ids[chatlogId] = messageId
+        self.messages += len(messages)
+
+        for old, _, _, ruleset in profiles:
+            ruleset_store.save(self.userId, new_profiles[old], ruleset)
+
+    def finish(self):
+        """Make everything imported visible at once."""
+        with db.connection() as conn:
+            conn.executemany(
+                "UPDATE model_profiles SET deletedAt = NULL WHERE userId = ? AND profileId = ?",
+                [(self.userId, profileId) for profileId in self.profile_ids.values()]
+            )
+            conn.executemany(
+                "UPDATE chat_logs SET deletedAt = NULL WHERE chatlogId = ?",
+                [(chatlogId,) for chatlogId in self.chatlog_ids.values()]
+            )
+            # lastMessageId must cover every imported message, whatever the export said.
+            conn.executemany(
+                "UPDATE chat_logs SET lastMessageId = MAX(lastMessageId, ?) WHERE chatlogId = ?",
+                [(messageId, chatlogId) for chatlogId, messageId in self.last_message_ids.items()]
+            )
+            conn.commit()
+
+    def abort(self):
+        """Queue the hidden rows of a failed import for deletion."""
+        if not self.profile_ids:
+            return
+        with db.connection() as conn:
+            cursor = conn.cursor()
+            for profileId in self.profile_ids.values():
+                deletions.enqueue_profile(cursor, self.userId, profileId)
+            conn.commit()
+        for profileId in self.profile_ids.values():
+            ruleset_store.delete(self.userId, profileId)
+        deletions.wake()
+
+    def summary(self):
+        return {
+            "profiles": len(self.profile_ids),
+            "chats": len(self.chatlog_ids),
+            "messages": self.messages,
+            "profileIds": self.profile_ids,
+            "chatlogIds": self.chatlog_ids,
+        }
+
+
+async def _batches(chunks):
+    """Split a byte stream into batches of (line number, line) pairs."""
+    buffer = bytearray()
+    batch = []
+    batch_bytes = 0
+    line_no = 0
+    async for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line_no += 1
+            line = bytes(buffer[start:end]).strip()
+            start = end + 1
+            if line:
+                batch.append((line_no, line))
+                batch_bytes += len(line)
+                if len(batch) >= IMPORT_BATCH_ROWS or batch_bytes >= IMPORT_BATCH_BYTES:
+                    yield batch
+                    batch = []
+                    batch_bytes = 0
+        del buffer[:start]
+        if len(buffer) > IMPORT_MAX_LINE_BYTES:
+            raise _invalid(line_no + 1, f"line is longer than {IMPORT_MAX_LINE_BYTES} bytes")
+
+    line = bytes(buffer).strip()
+    if line:
+        batch.append((line_no + 1, line))
+    if batch:
+        yield batch
+
+
+async def import_user(userId: str, chunks):
+    """Import an NDJSON export read from the async byte iterator `chunks`."""
+    importer = Importer(userId)
+    try:
+        async for batch in _batches(chunks):
+            await db.run(importer.write_batch, batch)
+        await db.run(importer.finish)
+    except BaseException:
+        await db.run(importer.abort)
+        raise
+    return importer.summary()
@@ -0,0 +1,343 @@
+"""Load-test the real FastAPI app against a seeded database and a local fake LLM.
+
+    python backend/benchmarks/bench_app.py --users 200 --requests 500 --concurrency 32 --output report.json
+    python backend/benchmarks/bench_app.py --output new.json --compare report.json
+
+Requests go through the ASGI app in-process, so results measure the server
+(routing, auth, SQLite, password hashing, LLM plumbing) rather than the network.
+Each run writes a JSON report with p50/p95/p99 latency and requests/sec per
+scenario; --compare prints the change against an earlier report.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parents[0] / "app"))
+sys.path.insert(0, str(BENCH_DIR))
+
+SCENARIOS = ["register", "login", "chat_turn", "chat_stream", "history", "noisy_neighbor", "delete_profile"]
+OK_STATUSES = {200, 202, 304}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def summarize(latencies, statuses, duration):
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None  # noqa: E731
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for status, count in statuses.items() if status not in OK_STATUSES),
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=lambda s: str(s[0]))},
+        "duration_s": round(duration, 3),
+        "rps": round(len(latencies) / duration, 2) if duration > 0 else None,
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+
+async def drive(requests, concurrency, send):
+    """Call send(i) for i in range(requests) with at most `concurrency` in flight."""
+    latencies = []
+    statuses = Counter()
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                status = await send(i)
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, statuses, time.perf_counter() - started)
+
+
+class Bench:
+    def __init__(self, client, seeded, args):
+        self.client = client
+        self.seeded = seeded
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.tokens = {}
+
+    def headers(self, username):
+        return {"Authorization": f"Bearer {self.tokens[username]}"}
+
+    async def register(self, i):
+        r = await self.client.post("/register", json={
+            "username": f"storm_user{i}", "email": f"storm_user{i}@bench.example.com", "password": self.seeded.password
+        })
+        return r.status_code
+
+    async def login(self, i):
+        _, email = self.seeded.users[i % len(self.seeded.users)]
+        r = await self.client.post("/login", json={"email": email, "password": self.seeded.password})
+        return r.status_code
+
+    async def chat_turn(self, i):
+        chatlogId, username, _ = self.rng.choice(self.seeded.chats)
+        return await self.ask(chatlogId, username, f"benchmark question {i}")
+
+    async def ask(self, chatlogId, username, prompt):
+        r = await self.client.post(
+            "/chats/response", json={"prompt": prompt, "chatlogId": chatlogId}, headers=self.headers(username)
+        )
+        return r.status_code
+
+    async def noisy_neighbor(self, requests):
+        """Chat turns from ordinary users while one user floods the LLM with
+        `concurrency` requests at a time, retrying 429s after a short pause.
+        The latencies reported are the ordinary users'."""
+        noisy_user = self.seeded.users[0][0]
+        noisy_chats = [c for c in self.seeded.chats if c[1] == noisy_user]
+        chats = [c for c in self.seeded.chats if c[1] != noisy_user]
+        noisy_statuses = Counter()
+        flooding = True
+
+        async def flood(worker):
+            n = 0
+            while flooding:
+                chatlogId, username, _ = noisy_chats[n % len(noisy_chats)]
+                status = await self.ask(chatlogId, username, f"noisy question {worker}-{n}")
+                noisy_statuses[status] += 1
+                n += 1
+                if status == 429:
+                    await asyncio.sleep(0.05)
+
+        async def turn(i):
+            chatlogId, username, _ = self.rng.choice(chats)
+            return await self.ask(chatlogId, username, f"neighbour question {i}")
+
+        flooders = [asyncio.create_task(flood(worker)) for worker in range(self.args.concurrency)]
+        # Let the flood fill the queue before measuring.
+        await asyncio.sleep(1)
+        result = await drive(requests, max(self.args.concurrency // 4, 1), turn)
+        flooding = False
+        await asyncio.gather(*flooders)
+        result["noisy_statuses"] = {str(status): count for status, count in sorted(noisy_statuses.items(), key=lambda s: str(s[0]))}
+        return result
+
+    async def chat_stream(self, i):
+        chatlogId, username, _ = self.rng.choice(self.seeded.chats)
+        async with self.client.stream(
+            "POST", "/chats/response", params={"stream": "true"},
+            json={"prompt": f"benchmark streamed question {i}", "chatlogId": chatlogId},
+            headers=self.headers(username)
+        ) as r:
+            body = b"".join([chunk async for chunk in r.aiter_bytes()])
+        if r.status_code == 200 and b"event: error" in body:
+            return "stream_error"
+        return r.status_code
+
+    async def history(self, i):
+        chatlogId, username, profileId = self.rng.choice(self.seeded.chats)
+        r = await self.client.get(f"/chats/{username}/{profileId}/{chatlogId}/messages", headers=self.headers(username))
+        return r.status_code
+
+    async def delete_profile(self, i):
+        username, profileId = self.deletable[i]
+        r = await self.client.delete(f"/profiles/{username}/{profileId}", headers=self.headers(username))
+        return r.status_code
+
+    async def wait_for_deletions(self):
+        import db
+
+        def pending():
+            with db.connection() as conn:
+                return conn.execute("SELECT COUNT(*) FROM deletion_jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+
+        started = time.perf_counter()
+        while await db.run(pending):
+            await asyncio.sleep(0.05)
+        return time.perf_counter() - started
+
+    async def run(self, scenario):
+        requests = self.args.requests
+        if scenario == "delete_profile":
+            # Each request deletes a different profile; the chats it owns are
+            # dropped from the pool so later scenarios don't target them.
+            self.deletable = self.seeded.profiles[-min(requests, len(self.seeded.profiles) // 2):]
+            requests = len(self.deletable)
+        if scenario == "noisy_neighbor":
+            return await self.noisy_neighbor(requests)
+        result = await drive(requests, self.args.concurrency, getattr(self, scenario))
+        if scenario == "delete_profile":
+            result["background_drain_s"] = round(await self.wait_for_deletions(), 3)
+            gone = set(self.deletable)
+            self.seeded.chats = [c for c in self.seeded.chats if (c[1], c[2]) not in gone]
+            self.seeded.profiles = [p for p in self.seeded.profiles if p not in gone]
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(name, result):
+    latency = result["latency_ms"]
+    print(
+        f"{name:<15} {result['requests']:>6} req  {result['rps'] or 0:>9.1f} req/s  "
+        f"p50 {latency['p50'] or 0:>9.1f} ms  p95 {latency['p95'] or 0:>9.1f} ms  "
+        f"p99 {latency['p99'] or 0:>9.1f} ms  errors {result['errors']}"
+    )
+
+
+def print_comparison(report, baseline):
+    print(f"\nCompared with {baseline['meta'].get('commit') or 'baseline'}:")
+    for name, result in report["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None:
+            continue
+        changes = []
+        for key in ("p50", "p95", "p99"):
+            new_value, old_value = result["latency_ms"][key], old["latency_ms"][key]
+            if new_value is not None and old_value:
+                changes.append(f"{key} {(new_value - old_value) / old_value * 100:+.1f}%")
+        if result["rps"] and old["rps"]:
+            changes.append(f"rps {(result['rps'] - old['rps']) / old['rps'] * 100:+.1f}%")
+        print(f"    {name:<15} {'  '.join(changes)}")
+
+
+async def run_scenarios(args, seeded, provider):
+    import httpx
+    import main as app_main
+
+    bench = Bench(None, seeded, args)
+    for username, email in seeded.users:
+        bench.tokens[username] = app_main.create_access_token(data={"sub": email})
+
+    results = {}
+    async with app_main.lifespan(app_main.app):
+        transport = httpx.ASGITransport(app=app_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            bench.client = client
+            for scenario in args.scenarios:
+                calls_before = provider.calls
+                results[scenario] = await bench.run(scenario)
+                results[scenario]["llm_calls"] = provider.calls - calls_before
+                print_result(scenario, results[scenario])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--profiles-per-user", type=int, default=3)
+    parser.add_argument("--chats-per-profile", type=int, default=4)
+    parser.add_argument("--messages-per-chat", type=int, default=40)
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--llm-latency-median-ms", type=float, default=800)
+    parser.add_argument("--llm-latency-p99-ms", type=float, default=3000)
+    parser.add_argument("--llm-response-words", type=int, default=120)
+    parser.add_argument("--llm-chunk-interval-ms", type=float, default=20)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of LLM calls failing with a retryable 503")
+    parser.add_argument("--llm-stall-rate", type=float, default=0.0, help="Share of LLM calls that hang for --llm-stall-ms")
+    parser.add_argument("--llm-stall-ms", type=float, default=120000)
+    parser.add_argument("--llm-tiers", help="JSON passed to the app as LLM_TIERS, e.g. to lift the free tier's rate limits")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    parser.add_argument("--compare", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app reads its configuration at import time, so set it up first.
+        os.environ["DB_PATH"] = str(Path(tmp) / "bench.db")
+        os.environ["RULESET_DIR"] = str(Path(tmp) / "rulesets")
+        os.environ["LLM_CACHE_DIR"] = str(Path(tmp) / "llm_cache")
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+        os.environ.setdefault("SECRET_KEY", "benchmark")
+        if args.llm_tiers:
+            os.environ["LLM_TIERS"] = args.llm_tiers
+
+        import fake_llm
+        import seed_data
+
+        provider = fake_llm.install(fake_llm.FakeLLMConfig(
+            latency_median_ms=args.llm_latency_median_ms,
+            latency_p99_ms=args.llm_latency_p99_ms,
+            response_words=args.llm_response_words,
+            chunk_interval_ms=args.llm_chunk_interval_ms,
+            error_rate=args.llm_error_rate,
+            stall_rate=args.llm_stall_rate,
+            stall_ms=args.llm_stall_ms,
+            seed=args.seed,
+        ))
+
+        started = time.perf_counter()
+        seeded = seed_data.seed(
+            users=args.users, profiles_per_user=args.profiles_per_user,
+            chats_per_profile=args.chats_per_profile, messages_per_chat=args.messages_per_chat,
+            random_seed=args.seed
+        )
+        seed_seconds = time.perf_counter() - started
+        print(
+            f"Seeded {len(seeded.users)} users, {len(seeded.profiles)} profiles, {len(seeded.chats)} chats "
+            f"and {seeded.messages} messages in {seed_seconds:.1f}s\n"
+        )
+
+        results = asyncio.run(run_scenarios(args, seeded, provider))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed_seconds": round(seed_seconds, 3),
+            "args": vars(args),
+        },
+        "scenarios": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Seed a database with the pre-migration schema, then show how the migrations
+change query plans and timings for the hot chat queries.
+
+    python backend/benchmarks/bench_migrations.py --messages 1000000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+import migrations  # noqa: E402
+
+# The schema makeDB.py created before versioned migrations existed.
+LEGACY_SCHEMA = [
+    '''CREATE TABLE users (
+        username TEXT NOT NULL UNIQUE PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        hashed_pass TEXT NOT NULL
+    )''',
+    '''CREATE TABLE model_profiles (
+        userId TEXT NOT NULL,
+        profileId INTEGER NOT NULL,
+        profileName TEXT NOT NULL,
+        model TEXT NOT NULL,
+        UNIQUE (userId, profileId)
+    )''',
+    '''CREATE TABLE chat_logs (
+        chatlogId INTEGER PRIMARY KEY AUTOINCREMENT,
+        userId TEXT NOT NULL,
+        profileId INTEGER NOT NULL,
+        FOREIGN KEY (userId, profileId) REFERENCES model_profiles (userId, profileId)
+    )''',
+    '''CREATE TABLE messages (
+        chatlogId INTEGER NOT NULL,
+        messageId INTEGER NOT NULL,
+        sender TEXT NOT NULL CHECK(sender IN ('user', 'llm')),
+        messageContent TEXT NOT NULL,
+        PRIMARY KEY (chatlogId, messageId),
+        FOREIGN KEY (chatlogId) REFERENCES chat_logs (chatlogId)
+    )''',
+]
+
+# name -> (query before migrations, query after migrations, parameter source)
+QUERIES = {
+    "chats for a profile (get_user_chats, delete_user_profile)": (
+        "SELECT chatlogId FROM chat_logs WHERE userId = ? AND profileId = ?",
+        "SELECT chatlogId FROM chat_logs WHERE userId = ? AND profileId = ?",
+        "profile",
+    ),
+    "next messageId (get_chat_response)": (
+        "SELECT MAX(messageId) FROM messages WHERE chatlogId = ?",
+        "SELECT lastMessageId FROM chat_logs WHERE chatlogId = ?",
+        "chat",
+    ),
+}
+
+
+def seed(conn, users, profiles_per_user, messages, messages_per_chat):
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    for statement in LEGACY_SCHEMA:
+        conn.execute(statement)
+
+    conn.executemany(
+        "INSERT INTO users (username, email, hashed_pass) VALUES (?, ?, ?)",
+        ((f"user{u}", f"user{u}@example.com", "x") for u in range(users))
+    )
+    profiles = [(f"user{u}", u * profiles_per_user + p) for u in range(users) for p in range(profiles_per_user)]
+    conn.executemany(
+        "INSERT INTO model_profiles (userId, profileId, profileName, model) VALUES (?, ?, ?, ?)",
+        ((userId, profileId, f"profile {profileId}", "gemini-2.5-flash") for userId, profileId in profiles)
+    )
+
+    chats = max(messages // messages_per_chat, 1)
+    rng = random.Random(42)
+    conn.executemany(
+        "INSERT INTO chat_logs (chatlogId, userId, profileId) VALUES (?, ?, ?)",
+        ((chatlogId, *rng.choice(profiles)) for chatlogId in range(1, chats + 1))
+    )
+    body = "lorem ipsum dolor sit amet " * 4
+    conn.executemany(
+        "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+        ((n // messages_per_chat + 1, n % messages_per_chat, "user" if n % 2 == 0 else "llm", body) for n in range(chats * messages_per_chat))
+    )
+    conn.commit()
+    return profiles, chats
+
+
+def measure(conn, label, queries, profiles, chats, runs):
+    rng = random.Random(7)
+    results = {}
+    for name, sql in queries.items():
+        source = QUERIES[name][2]
+        params = [rng.choice(profiles) if source == "profile" else (rng.randint(1, chats),) for _ in range(runs)]
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params[0])]
+
+        started = time.perf_counter()
+        for p in params:
+            conn.execute(sql, p).fetchall()
+        elapsed = time.perf_counter() - started
+
+        results[name] = {"sql": sql, "plan": plan, "mean_us": elapsed / runs * 1e6}
+        print(f"[{label}] {name}")
+        print(f"    {sql}")
+        for step in plan:
+            print(f"    plan: {step}")
+        print(f"    mean: {results[name]['mean_us']:.1f} us over {runs} runs")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--messages-per-chat", type=int, default=50)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--profiles-per-user", type=int, default=5)
+    parser.add_argument("--runs", type=int, default=2_000)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.db"
+        os.environ["RULESET_DIR"] = str(Path(tmp) / "rulesets")
+        conn = sqlite3.connect(db_path)
+
+        started = time.perf_counter()
+        profiles, chats = seed(conn, args.users, args.profiles_per_user, args.messages, args.messages_per_chat)
+        print(f"Seeded {chats} chats / {chats * args.messages_per_chat} messages in {time.perf_counter() - started:.1f}s\n")
+        conn.execute("PRAGMA journal_mode=WAL")
+
+        before = measure(conn, "before", {name: q[0] for name, q in QUERIES.items()}, profiles, chats, args.runs)
+        conn.close()
+
+        started = time.perf_counter()
+        applied = migrations.migrate(db_path, ruleset_dir=Path(tmp) / "rulesets")
+        migrate_seconds = time.perf_counter() - started
+        print(f"\nApplied migrations {applied} in {migrate_seconds:.1f}s\n")
+
+        conn = sqlite3.connect(db_path)
+        after = measure(conn, "after", {name: q[1] for name, q in QUERIES.items()}, profiles, chats, args.runs)
+        conn.close()
+
+    print("\nSpeed-up:")
+    for name in QUERIES:
+        print(f"    {name}: {before[name]['mean_us'] / after[name]['mean_us']:.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "migrate_seconds": migrate_seconds, "before": before, "after": after}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Seed a database, build the message search index and time searches against it.
+
+    python backend/benchmarks/bench_search.py --users 2000 --messages-per-chat 80
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parents[0] / "app"))
+sys.path.insert(0, str(BENCH_DIR))
+
+QUERIES = ["refund", "customer order", "warranty schedule meeting", "explain why", "no such word"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--profiles-per-user", type=int, default=3)
+    parser.add_argument("--chats-per-profile", type=int, default=4)
+    parser.add_argument("--messages-per-chat", type=int, default=40)
+    parser.add_argument("--runs", type=int, default=200, help="Searches per query")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.db"
+        os.environ["DB_PATH"] = str(db_path)
+        os.environ["RULESET_DIR"] = str(Path(tmp) / "rulesets")
+
+        import search
+        import seed_data
+
+        started = time.perf_counter()
+        seeded = seed_data.seed(
+            users=args.users, profiles_per_user=args.profiles_per_user,
+            chats_per_profile=args.chats_per_profile, messages_per_chat=args.messages_per_chat
+        )
+        print(f"Seeded {seeded.messages} messages (indexed by the insert trigger) in {time.perf_counter() - started:.1f}s")
+
+        conn = sqlite3.connect(db_path)
+        conn.execute("DELETE FROM messages_fts")
+        conn.commit()
+        conn.close()
+        started = time.perf_counter()
+        indexed = search.backfill(db_path)
+        backfill_seconds = time.perf_counter() - started
+        print(f"Backfilled {indexed} messages from scratch in {backfill_seconds:.1f}s\n")
+
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        rng = random.Random(7)
+        results = {}
+        for query in QUERIES:
+            timings = []
+            for _ in range(args.runs):
+                userId, _ = rng.choice(seeded.users)
+                t = time.perf_counter()
+                search.search(conn.cursor(), userId, query, search.SEARCH_PAGE_SIZE, 0)
+                timings.append(time.perf_counter() - t)
+            timings.sort()
+            results[query] = {
+                "p50_ms": timings[len(timings) // 2] * 1000,
+                "p99_ms": timings[min(int(len(timings) * 0.99), len(timings) - 1)] * 1000,
+            }
+            print(f"{query!r:<30} p50 {results[query]['p50_ms']:.2f} ms  p99 {results[query]['p99_ms']:.2f} ms")
+        conn.close()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "messages": seeded.messages, "backfill_seconds": backfill_seconds, "queries": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
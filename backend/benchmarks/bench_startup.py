@@ -0,0 +1,87 @@
+"""Measure worker cold start: how long `import main` takes, how long the lifespan
+startup takes, and how long a model build right after startup takes (it waits for
+the background provider warm-up). Each sample runs in a fresh interpreter so
+nothing is already imported or cached.
+
+    python backend/benchmarks/bench_startup.py --runs 10 --json startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parents[1] / "app"
+
+PROBE = r"""
+import asyncio, json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+sdk_loaded_by_import = "google.generativeai" in sys.modules
+
+async def startup():
+    async with main.lifespan(main.app):
+        ready = time.perf_counter()
+        import llm
+        llm.build_model("You are a benchmark.")
+        return ready, time.perf_counter()
+
+ready, first_model = asyncio.run(startup())
+print(json.dumps({
+    "import_s": imported - started,
+    "lifespan_s": ready - imported,
+    "first_model_s": first_model - ready,
+    "sdk_loaded_by_import": sdk_loaded_by_import,
+}))
+"""
+
+
+def sample(env):
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=APP_DIR, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--providers", default="gemini,stub", help="Comma-separated LLM_PROVIDER values to measure")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for provider in [p.strip() for p in args.providers.split(",") if p.strip()]:
+            env = dict(
+                os.environ,
+                DB_PATH=str(Path(tmp) / "startup.db"),
+                RULESET_DIR=str(Path(tmp) / "rulesets"),
+                LLM_PROVIDER=provider,
+                API_KEY=os.environ.get("API_KEY", "startup-benchmark"),
+                SECRET_KEY=os.environ.get("SECRET_KEY", "startup-benchmark"),
+            )
+            samples = [sample(env) for _ in range(args.runs)]
+            results[provider] = {
+                key: statistics.median(s[key] for s in samples) * 1000
+                for key in ("import_s", "lifespan_s", "first_model_s")
+            }
+            results[provider]["sdk_loaded_by_import"] = any(s["sdk_loaded_by_import"] for s in samples)
+            r = results[provider]
+            print(
+                f"{provider:<8} import main {r['import_s']:7.1f} ms   lifespan startup {r['lifespan_s']:7.1f} ms   "
+                f"first model build {r['first_model_s']:7.1f} ms   (median of {args.runs})"
+                + ("   [import main loaded the Gemini SDK]" if r["sdk_loaded_by_import"] else "")
+            )
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
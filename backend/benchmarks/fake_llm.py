@@ -0,0 +1,110 @@
+"""A local stand-in for the Gemini provider.
+
+install() swaps it in before the app builds any models, so benchmarks exercise
+the real request path without network access. Latency follows a log-normal
+distribution described by its median and p99, and streamed responses are
+delivered a few words at a time. Faults can be injected: errors that look like
+a Gemini 503, and stalls that never answer within any sensible deadline.
+"""
+import asyncio
+import math
+import random
+from dataclasses import dataclass
+
+
+@dataclass
+class FakeLLMConfig:
+    latency_median_ms: float = 800.0
+    latency_p99_ms: float = 3000.0
+    response_words: int = 120
+    words_per_chunk: int = 4
+    chunk_interval_ms: float = 20.0
+    error_rate: float = 0.0
+    stall_rate: float = 0.0
+    stall_ms: float = 120000.0
+    seed: int = 1234
+
+
+class FakeLLMError(Exception):
+    # Gemini's errors carry the HTTP status as `code`; 503 is what an overloaded upstream returns.
+    code = 503
+
+
+class _Part:
+    def __init__(self, text):
+        self.text = text
+        self.candidates = []
+
+
+class _Stream:
+    def __init__(self, provider, words):
+        self._provider = provider
+        self._words = words
+
+    async def __aiter__(self):
+        step = self._provider.config.words_per_chunk
+        for start in range(0, len(self._words), step):
+            await asyncio.sleep(self._provider.config.chunk_interval_ms / 1000)
+            yield _Part(" ".join(self._words[start:start + step]) + " ")
+
+
+class _ChatSession:
+    def __init__(self, provider, history):
+        self._provider = provider
+        self.history = list(history or [])
+
+    async def send_message_async(self, prompt, stream=False):
+        words = await self._provider.respond(prompt)
+        if stream:
+            return _Stream(self._provider, words)
+        return _Part(" ".join(words))
+
+
+class FakeGenerativeModel:
+    def __init__(self, provider, model_name=None, system_instruction=None, generation_config=None):
+        self.provider = provider
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.generation_config = generation_config
+
+    def start_chat(self, history=None):
+        return _ChatSession(self.provider, history)
+
+    async def generate_content_async(self, contents, **kwargs):
+        return _Part(" ".join(await self.provider.respond(contents)))
+
+
+class FakeProvider:
+    name = "fake"
+
+    def __init__(self, config: FakeLLMConfig):
+        self.config = config
+        self.calls = 0
+        self._rng = random.Random(config.seed)
+        self._mu = math.log(config.latency_median_ms)
+        # 2.326 is the z-score of the 99th percentile.
+        self._sigma = max(math.log(config.latency_p99_ms / config.latency_median_ms) / 2.326, 0.0)
+
+    def sample_latency(self) -> float:
+        return self._rng.lognormvariate(self._mu, self._sigma) / 1000
+
+    def build_model(self, model_name, system_instruction=None, generation_config=None):
+        return FakeGenerativeModel(self, model_name, system_instruction, generation_config)
+
+    async def respond(self, prompt):
+        self.calls += 1
+        if self._rng.random() < self.config.stall_rate:
+            await asyncio.sleep(self.config.stall_ms / 1000)
+        await asyncio.sleep(self.sample_latency())
+        if self._rng.random() < self.config.error_rate:
+            raise FakeLLMError("simulated upstream failure")
+        return [f"word{n}" for n in range(self.config.response_words)]
+
+
+def install(config: FakeLLMConfig = None) -> FakeProvider:
+    """Make the app's LLM calls use the fake and return the provider driving it."""
+    import providers
+
+    provider = FakeProvider(config or FakeLLMConfig())
+    providers.install(provider)
+    return provider
@@ -0,0 +1,147 @@
+"""Seed a database and ruleset directory with realistic-looking users, profiles,
+rulesets, chats and messages.
+
+    python backend/benchmarks/seed_data.py --users 500 --db-path /tmp/bench.db --ruleset-dir /tmp/rulesets
+
+Every seeded user has the same password (--password) so load tests can log in.
+Without --db-path the app's own database.db and rulesets directory are used.
+"""
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+import passwords  # noqa: E402
+import ruleset_store  # noqa: E402
+
+WORDS = (
+    "the model should answer questions about rules policy customer order refund "
+    "shipping account password support product price warranty schedule meeting "
+    "report summary please explain why how when where which example detail"
+).split()
+
+DEFAULT_PASSWORD = "benchmark-password"
+
+
+@dataclass
+class SeedResult:
+    password: str
+    users: list = field(default_factory=list)     # (username, email)
+    profiles: list = field(default_factory=list)  # (userId, profileId)
+    chats: list = field(default_factory=list)     # (chatlogId, userId, profileId)
+    messages: int = 0
+
+
+def _sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _ruleset(rng):
+    return {
+        "persona": _sentence(rng, 3, 8),
+        "rules": [_sentence(rng, 6, 20) for _ in range(rng.randint(3, 15))],
+        "tone": rng.choice(["formal", "friendly", "concise"]),
+    }
+
+
+def _message_count(rng, mean, cap):
+    # Most chats are short and a few are very long.
+    count = int(rng.expovariate(1 / mean)) if mean > 0 else 0
+    return min(max(count // 2 * 2, 2), cap)
+
+
+def seed(db_path=None, ruleset_dir=None, users=200, profiles_per_user=3, chats_per_profile=4,
+         messages_per_chat=40, max_messages_per_chat=1000, password=DEFAULT_PASSWORD, random_seed=42):
+    db_path = Path(db_path or db.DB_PATH)
+    if ruleset_dir is not None:
+        ruleset_store.UPLOAD_DIR = Path(ruleset_dir)
+    rng = random.Random(random_seed)
+    result = SeedResult(password=password)
+
+    migrations.migrate(db_path, ruleset_dir=ruleset_store.UPLOAD_DIR)
+    # Every user shares one hash; hashing each one would dominate seeding time.
+    hashed = passwords.pwd_context.hash(password)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        profileId = conn.execute("SELECT IFNULL(MAX(value), 0) FROM counters WHERE name = 'profileId'").fetchone()[0]
+        # Continue numbering after earlier runs so re-seeding the same database works.
+        offset = conn.execute("SELECT COUNT(*) FROM users WHERE email LIKE '%@bench.example.com'").fetchone()[0]
+
+        for u in range(offset, offset + users):
+            username = f"bench_user{u}"
+            email = f"{username}@bench.example.com"
+            conn.execute("INSERT INTO users (username, email, hashed_pass) VALUES (?, ?, ?)", (username, email, hashed))
+            result.users.append((username, email))
+
+            for _ in range(profiles_per_user):
+                path = ruleset_store.ruleset_path(username, profileId)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(path, "w") as f:
+                    json.dump(_ruleset(rng), f, indent=4)
+                conn.execute(
+                    "INSERT INTO model_profiles (userId, profileId, profileName, model) VALUES (?, ?, ?, ?)",
+                    (username, profileId, _sentence(rng, 1, 3), "gemini")
+                )
+                result.profiles.append((username, profileId))
+
+                for _ in range(chats_per_profile):
+                    count = _message_count(rng, messages_per_chat, max_messages_per_chat)
+                    chatlogId = conn.execute(
+                        "INSERT INTO chat_logs (userId, profileId, lastMessageId) VALUES (?, ?, ?)",
+                        (username, profileId, count - 1)
+                    ).lastrowid
+                    conn.executemany(
+                        "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+                        ((chatlogId, m, "user" if m % 2 == 0 else "llm",
+                          _sentence(rng, 4, 20) if m % 2 == 0 else _sentence(rng, 20, 120)) for m in range(count))
+                    )
+                    result.chats.append((chatlogId, username, profileId))
+                    result.messages += count
+
+                profileId += 1
+
+        conn.execute("""
+            INSERT INTO counters (name, value) VALUES ('profileId', ?)
+            ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)
+        """, (profileId,))
+        conn.commit()
+    finally:
+        conn.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-path")
+    parser.add_argument("--ruleset-dir")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--profiles-per-user", type=int, default=3)
+    parser.add_argument("--chats-per-profile", type=int, default=4)
+    parser.add_argument("--messages-per-chat", type=int, default=40, help="Mean; chat lengths are exponentially distributed")
+    parser.add_argument("--max-messages-per-chat", type=int, default=1000)
+    parser.add_argument("--password", default=DEFAULT_PASSWORD)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    result = seed(
+        args.db_path, args.ruleset_dir, args.users, args.profiles_per_user, args.chats_per_profile,
+        args.messages_per_chat, args.max_messages_per_chat, args.password, args.seed
+    )
+    print(
+        f"Seeded {len(result.users)} users, {len(result.profiles)} profiles, {len(result.chats)} chats "
+        f"and {result.messages} messages in {time.perf_counter() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
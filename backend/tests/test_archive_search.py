@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+_tmp = tempfile.mkdtemp()
+os.environ["DB_PATH"] = str(Path(_tmp) / "test.db")
+os.environ["RULESET_DIR"] = str(Path(_tmp) / "rulesets")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app"))
+
+import archive  # noqa: E402
+import db  # noqa: E402
+import migrations  # noqa: E402
+import search  # noqa: E402
+
+
+def _seed_chat(username: str) -> int:
+    conn = sqlite3.connect(db.DB_PATH)
+    try:
+        conn.execute("INSERT INTO users (username, email, hashed_pass) VALUES (?, ?, 'x')", (username, f"{username}@example.com"))
+        conn.execute("INSERT INTO model_profiles (userId, profileId, profileName, model) VALUES (?, 0, 'p', 'gemini')", (username,))
+        chatlogId = conn.execute(
+            "INSERT INTO chat_logs (userId, profileId, lastMessageId) VALUES (?, 0, 1)", (username,)
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO messages (chatlogId, messageId, sender, messageContent) VALUES (?, ?, ?, ?)",
+            [(chatlogId, 0, "user", "where is my walrus"), (chatlogId, 1, "llm", "your walrus is at the zoo")]
+        )
+        conn.execute("UPDATE chat_logs SET lastActiveAt = datetime('now', '-90 days') WHERE chatlogId = ?", (chatlogId,))
+        conn.commit()
+    finally:
+        conn.close()
+    return chatlogId
+
+
+def _search(username: str, query: str):
+    with db.connection() as conn:
+        results, _ = search.search(conn.cursor(), username, query, 10, 0)
+    return results
+
+
+def test_search_finds_archived_chat():
+    migrations.migrate()
+    chatlogId = _seed_chat("alice")
+    assert len(_search("alice", "walrus")) == 2
+
+    assert archive.archive_chat(chatlogId, 30) is not None
+    results = _search("alice", "walrus")
+    assert sorted((r["chatlogId"], r["messageId"], r["sender"]) for r in results) == [
+        (chatlogId, 0, "user"), (chatlogId, 1, "llm")
+    ]
+    assert all("<mark>walrus</mark>" in r["snippet"] for r in results)
+
+    # Rehydrating must not index the messages a second time.
+    with db.connection() as conn:
+        archive.rehydrate(conn.cursor(), chatlogId)
+        conn.commit()
+    assert len(_search("alice", "walrus")) == 2
+
+    # Deleting an archived chat drops its index rows with it.
+    assert archive.archive_chat(chatlogId, 30) is not None
+    with db.connection() as conn:
+        conn.execute("DELETE FROM chat_logs WHERE chatlogId = ?", (chatlogId,))
+        conn.commit()
+        assert conn.execute(
+            "SELECT COUNT(*) FROM messages_fts WHERE rowid BETWEEN ? AND ?", (chatlogId << 32, (chatlogId << 32) + 0xFFFFFFFF)
+        ).fetchone()[0] == 0
@@ -11,6 +11,8 @@ export default function ChatBox({
   className = "",
   messages = [],
   setMessages,
+  hasOlderMessages = false,
+  onLoadOlder,
   activeChat,
   activeProfile,
   userId,
@@ -24,12 +26,13 @@ export default function ChatBox({
   const scrollRef = useRef(null);
   const textareaRef = useRef(null);
 
-  // ✅ Auto-scroll to bottom when messages change
+  // ✅ Auto-scroll to bottom when new messages arrive (not when older pages are prepended)
+  const lastMessage = messages[messages.length - 1];
   useEffect(() => {
     if (scrollRef.current) {
       scrollRef.current.scrollTop = scrollRef.current.scrollHeight;
     }
-  }, [messages.length]);
+  }, [lastMessage]);
 
   // ✅ Auto-expand textarea height
   useEffect(() => {
@@ -61,9 +64,9 @@ export default function ChatBox({
     setMessages((prev) => [...prev, userMsg]);
 
     try {
-      // 2️⃣ Send message to backend
+      // 2️⃣ Send message to backend and stream the reply as it is generated
       const res = await authorizedFetch(
-        `/api/chats/response`,
+        `/api/chats/response?stream=true`,
         {
           method: "POST",
           headers: { "Content-Type": "application/json" },
@@ -75,12 +78,47 @@ export default function ChatBox({
       );
 
       if (!res.ok) throw new Error(`Failed to send message: ${res.status}`);
-      const data = await res.json();
 
-      // 3️⃣ Add AI reply from backend
-      if (data?.response) {
-        const aiMsg = { sender: "llm", content: data.response };
-        setMessages((prev) => [...prev, aiMsg]);
+      // 3️⃣ Append AI tokens to a single reply bubble as server-sent events arrive
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let started = false;
+
+      const appendToken = (token) => {
+        if (!started) {
+          started = true;
+          setIsLoading(false);
+          setMessages((prev) => [...prev, { sender: "llm", content: token }]);
+          return;
+        }
+        setMessages((prev) => {
+          const last = prev[prev.length - 1];
+          return [...prev.slice(0, -1), { ...last, content: last.content + token }];
+        });
+      };
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+          const rawEvent = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+
+          let event = "message";
+          let payload = "";
+          for (const line of rawEvent.split("\n")) {
+            if (line.startsWith("event: ")) event = line.slice(7);
+            else if (line.startsWith("data: ")) payload += line.slice(6);
+          }
+          const data = payload ? JSON.parse(payload) : {};
+
+          if (event === "token") appendToken(data.token);
+          else if (event === "error") throw new Error(data.detail);
+        }
       }
     } catch (error) {
       console.error("Error sending message:", error);
@@ -136,6 +174,16 @@ export default function ChatBox({
 
       {/* Message list */}
       <div ref={scrollRef} className="flex-1 overflow-y-auto space-y-4 px-4 py-3">
+        {hasOlderMessages && onLoadOlder && (
+          <div className="flex justify-center">
+            <button
+              onClick={onLoadOlder}
+              className="text-xs text-muted-foreground hover:text-foreground px-3 py-1 rounded-full border border-border"
+            >
+              Load older messages
+            </button>
+          </div>
+        )}
         {messages.length === 0 && (
           <div className="text-center text-sm text-muted-foreground mt-20">
             No messages yet — start chatting below!
@@ -17,28 +17,48 @@ export default function Layout() {
   const [model, setModel] = useState(null)
   const [activeChat, setActiveChat] = useState(() => localStorage.getItem("activeChat"))
   const [messages, setMessages] = useState([])
+  const [hasOlderMessages, setHasOlderMessages] = useState(false)
 
-  // fetch profiles after mount
+  // load profiles, chats and the open chat's messages in one request after mount
   useEffect(() => {
-    fetchProfiles()
+    fetchWorkspace()
   }, [])
 
-  useEffect(() => {
-  if (activeProfile != null) {
-    fetchChats(activeProfile)
-  }
-}, [])
-
-  const fetchProfiles = async () => {
-    const res = await authorizedFetch(`/api/profiles/${userId}`)
+  const fetchWorkspace = async () => {
+    const params = new URLSearchParams()
+    if (activeProfile != null) params.set("profileId", activeProfile)
+    if (activeChat != null) params.set("chatlogId", activeChat)
+    const res = await authorizedFetch(`/api/workspace?${params}`)
     const data = await res.json()
-   if (!Array.isArray(data.profiles)) {
-    setProfiles([])
-    setNoProfiles(true)
-    return
-  }
+    if (!Array.isArray(data.profiles)) {
+      setProfiles([])
+      setNoProfiles(true)
+      return
+    }
     setNoProfiles(data.profiles.length < 1)
     setProfiles(data.profiles)
+
+    // The server falls back to another chat if the stored ones are gone
+    const profile = data.profiles.find((p) => p.profileId === data.activeProfileId)
+    const chat = data.activeChat
+    if (profile) {
+      setActiveProfile(profile.profileId.toString())
+      localStorage.setItem("activeProfile", profile.profileId.toString())
+      setChats(profile.chats.map((c) => c.chatlogId))
+    } else {
+      setActiveProfile(null)
+      localStorage.removeItem("activeProfile")
+    }
+    if (chat) {
+      setActiveChat(chat.chatlogId.toString())
+      localStorage.setItem("activeChat", chat.chatlogId.toString())
+      setModel(chat.model)
+      setMessages(chat.messages)
+      setHasOlderMessages(Boolean(chat.hasMore))
+    } else {
+      setActiveChat(null)
+      localStorage.removeItem("activeChat")
+    }
   }
 
   const fetchChats = async (profileId) => {
@@ -56,11 +76,14 @@ export default function Layout() {
     if (!chatId || !profileId) {
       setMessages([]);
       setModel(null);
+      setHasOlderMessages(false);
       return;
     }
+    // Only the newest page is loaded up front; older pages are fetched on demand
     const res = await authorizedFetch(`/api/chats/${userId}/${profileId}/${chatId}/messages`)
     const data = await res.json()
     setModel(data.model);
+    setHasOlderMessages(Boolean(data.hasMore));
     if (!Array.isArray(data.messages)) {
     setMessages([])
     return
@@ -68,6 +91,20 @@ export default function Layout() {
     setMessages(data.messages)
   }
 
+  const loadOlderMessages = async () => {
+    const oldest = messages.find((m) => m.messageId !== undefined)
+    if (!oldest || !activeChat || !activeProfile) return
+    const res = await authorizedFetch(
+      `/api/chats/${userId}/${activeProfile}/${activeChat}/messages?before=${oldest.messageId}`
+    )
+    if (!res.ok) return
+    const data = await res.json()
+    setHasOlderMessages(Boolean(data.hasMore))
+    if (Array.isArray(data.messages)) {
+      setMessages((prev) => [...data.messages, ...prev])
+    }
+  }
+
   // when profile changes, store + reload chats
   const handleProfileSelect = async (id, cid) => {
     const stringID = id.toString();
@@ -93,6 +130,7 @@ export default function Layout() {
       localStorage.removeItem("activeChat");
       setMessages([]);
       setModel(null);
+      setHasOlderMessages(false);
     }
   }
 
@@ -134,6 +172,8 @@ export default function Layout() {
           title={`Chat ${activeChat}`} 
           messages ={messages}
           setMessages={setMessages}
+          hasOlderMessages={hasOlderMessages}
+          onLoadOlder={loadOlderMessages}
           activeChat={activeChat}
           activeProfile={activeProfile}
           userId={userId}